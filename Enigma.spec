@@ -1,5 +1,16 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# Modules the client never imports: test and doc tooling, Tk, and the
+# Markdown and TextArea widgets of Textual with their parsers. Pygments
+# stays, rich needs it to print tracebacks
+EXCLUDES = [
+    'tkinter', '_tkinter', 'unittest', 'doctest', 'pdb', 'pydoc', 'pydoc_data',
+    'lib2to3', 'sqlite3', '_sqlite3', 'xmlrpc', 'multiprocessing',
+    'markdown_it', 'linkify_it', 'uc_micro', 'mdurl',
+    'textual.widgets._markdown', 'textual.widgets._text_area', 'textual.document',
+    'tree_sitter',
+]
+
 
 a = Analysis(
     ['client.py'],
@@ -10,7 +21,7 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=EXCLUDES,
     noarchive=False,
     optimize=0,
 )
@@ -26,7 +37,7 @@ exe = EXE(
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    upx=False,
     upx_exclude=[],
     runtime_tmpdir=None,
     console=True,
@@ -0,0 +1,48 @@
+import asyncio
+
+
+# Admission control for new connections: a global cap, a per-IP cap and a
+# limit on handshakes in progress, so a connection flood is turned away
+# early instead of using up memory and file descriptors. A limit of 0
+# means unlimited
+
+class Admission:
+    def __init__(self, max_connections: int = 0, max_per_ip: int = 0, max_handshakes: int = 0):
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.handshakes = asyncio.Semaphore(max_handshakes) if max_handshakes else None
+        self.connections = 0
+        self.per_ip = {}
+        self.handshaking = 0
+        self.waiting = 0
+
+    def admit(self, ip) -> str:
+        # Returns why the connection is refused, or None when it is admitted
+        if self.max_connections and self.connections >= self.max_connections:
+            return "Server is full, try again later"
+        count = self.per_ip.get(ip, 0)
+        if self.max_per_ip and count >= self.max_per_ip:
+            return "Too many connections from your address"
+        self.connections += 1
+        self.per_ip[ip] = count + 1
+        return None
+
+    def release(self, ip):
+        self.connections -= 1
+        count = self.per_ip.pop(ip) - 1
+        if count:
+            self.per_ip[ip] = count
+
+    async def begin_handshake(self):
+        self.waiting += 1
+        try:
+            if self.handshakes is not None:
+                await self.handshakes.acquire()
+        finally:
+            self.waiting -= 1
+        self.handshaking += 1
+
+    def end_handshake(self):
+        self.handshaking -= 1
+        if self.handshakes is not None:
+            self.handshakes.release()
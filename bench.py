@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from protocol import PROTOCOL_VERSION, encode_message, read_frame
+
+
+# Load generator for server.py. Starts a server in a scratch directory,
+# connects simulated clients with the real handshake and measures
+# connections/sec, messages/sec and end-to-end broadcast latency.
+#
+#   python bench.py --clients 100,1000 --size 64,1024 --slow 0,10 --output results.json
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def parse_list(value: str) -> list:
+    return [int(v) for v in value.split(",") if v]
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def start_server(port: int, workers: int, extra_env: dict):
+    env = dict(os.environ)
+    env.update({
+        "SERVER_HOST": "127.0.0.1",
+        "SERVER_PORT": str(port),
+        "RATE_LIMIT": "1000000000",
+        "RATE_WINDOW": "1",
+        # Every simulated client connects from 127.0.0.1
+        "MAX_CONNECTIONS": "0",
+        "MAX_CONNECTIONS_PER_IP": "0",
+    })
+    env.update(extra_env)
+    with tempfile.TemporaryDirectory(prefix="enigma-bench-") as workdir:
+        process = subprocess.Popen(
+            [sys.executable, SERVER, "--workers", str(workers)],
+            cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            deadline = time.monotonic() + 10
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+                    break
+                except OSError:
+                    if process.poll() is not None or time.monotonic() > deadline:
+                        raise RuntimeError("Server did not start")
+                    time.sleep(0.05)
+            # With several workers give every one of them time to bind
+            time.sleep(0.2 * workers)
+            yield process
+        finally:
+            process.terminate()
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class BenchClient:
+    def __init__(self, name: str, binary: bool):
+        self.name = name
+        self.binary = binary
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.latencies = []
+
+    async def connect(self, port: int, encrypted: bool, room: str = None):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        handshake = {"username": self.name, "encrypted": encrypted}
+        if room is not None:
+            handshake["room"] = room
+        if self.binary:
+            handshake.update(version=PROTOCOL_VERSION, framing=["binary"])
+        self.writer.write(encode_message(handshake))
+        await self.writer.drain()
+        reply = json.loads(await self.reader.readline())
+        if not reply.get("text", "").startswith("Connected as"):
+            raise ConnectionError(reply.get("text"))
+
+    async def receive(self, expected: int, done: asyncio.Event):
+        while self.received < expected:
+            frame = await read_frame(self.reader, self.binary, 2 ** 24)
+            if frame is None:
+                break
+            message = frame.message
+            if message.get("system"):
+                continue
+            sent_ns = int(message["payload"].split("|", 1)[0])
+            self.latencies.append(time.perf_counter_ns() - sent_ns)
+            self.received += 1
+        done.set()
+
+    def send(self, size: int):
+        stamp = f"{time.perf_counter_ns()}|"
+        payload = stamp + "x" * max(0, size - len(stamp))
+        self.writer.write(encode_message({"username": self.name, "payload": payload}, self.binary))
+
+    async def flood(self, size: int):
+        # Sends as fast as the server takes it and throws away what comes back
+        async def discard():
+            while await self.reader.read(65536):
+                pass
+
+        drain = asyncio.create_task(discard())
+        payload = encode_message({"username": self.name, "payload": "x" * size}, self.binary)
+        try:
+            while True:
+                self.writer.write(payload)
+                await self.writer.drain()
+        finally:
+            drain.cancel()
+
+    def close(self):
+        with contextlib.suppress(Exception):
+            self.writer.close()
+
+
+async def run_scenario(port: int, run_id: int, clients: int, size: int, slow: int, flooders: int, encrypted: bool,
+                       binary: bool, senders: int, messages: int, flood_size: int, connect_concurrency: int,
+                       timeout: float) -> dict:
+    semaphore = asyncio.Semaphore(connect_concurrency)
+    handshake_times = []
+
+    async def connect(index: int, prefix: str, room: str = None) -> BenchClient:
+        client = BenchClient(f"b{run_id}{prefix}{index}", binary)
+        async with semaphore:
+            started = time.perf_counter()
+            await client.connect(port, encrypted, room)
+            if room is None:
+                handshake_times.append(time.perf_counter() - started)
+        return client
+
+    started = time.perf_counter()
+    readers = await asyncio.gather(*(connect(i, "r") for i in range(clients)))
+    connect_elapsed = time.perf_counter() - started
+    # Slow consumers join the room but never read from their socket
+    stalled = await asyncio.gather(*(connect(i, "s") for i in range(slow)))
+    # Flooders send big messages nonstop to a room of their own, so they
+    # compete with the senders for the server but not for the readers' queues
+    flooding = await asyncio.gather(*(connect(i, "f", "flood") for i in range(flooders)))
+    flood_tasks = [asyncio.create_task(c.flood(flood_size)) for c in flooding]
+    await asyncio.sleep(0.5)
+
+    senders = min(senders, clients)
+    # Senders do not receive their own messages back
+    expected = [(senders - (i < senders)) * messages for i in range(clients)]
+    events = [asyncio.Event() for _ in readers]
+    receive_tasks = [asyncio.create_task(c.receive(n, e)) for c, n, e in zip(readers, expected, events)]
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        for client in readers[:senders]:
+            client.send(size)
+        await asyncio.gather(*(c.writer.drain() for c in readers[:senders]))
+    send_elapsed = time.perf_counter() - started
+    try:
+        await asyncio.wait_for(asyncio.gather(*(e.wait() for e in events)), timeout)
+        timed_out = False
+    except asyncio.TimeoutError:
+        timed_out = True
+    delivery_elapsed = time.perf_counter() - started
+
+    for task in itertools.chain(receive_tasks, flood_tasks):
+        task.cancel()
+    for client in itertools.chain(readers, stalled, flooding):
+        client.close()
+
+    latencies = sorted(itertools.chain.from_iterable(c.latencies for c in readers))
+    delivered = sum(c.received for c in readers)
+    handshake_times.sort()
+    return {
+        "clients": clients,
+        "message_size": size,
+        "slow_consumers": slow,
+        "flooders": flooders,
+        "encrypted": encrypted,
+        "binary": binary,
+        "senders": senders,
+        "messages_per_sender": messages,
+        "connections_per_sec": clients / connect_elapsed if connect_elapsed else 0,
+        "handshake_p50_ms": percentile(handshake_times, 50) * 1e3,
+        "handshake_p99_ms": percentile(handshake_times, 99) * 1e3,
+        "messages_sent_per_sec": senders * messages / send_elapsed if send_elapsed else 0,
+        "messages_delivered": delivered,
+        "messages_expected": sum(expected),
+        "deliveries_per_sec": delivered / delivery_elapsed if delivery_elapsed else 0,
+        "latency_p50_ms": percentile(latencies, 50) / 1e6,
+        "latency_p99_ms": percentile(latencies, 99) / 1e6,
+        "latency_p999_ms": percentile(latencies, 99.9) / 1e6,
+        "timed_out": timed_out,
+    }
+
+
+def print_result(result: dict):
+    mode = ("enc" if result["encrypted"] else "plain") + ("/bin" if result["binary"] else "/json")
+    print(
+        f"{mode:10} clients={result['clients']:<6} size={result['message_size']:<6} slow={result['slow_consumers']:<4} "
+        f"flood={result['flooders']:<3} coalesce={result['coalesce_ms']:<3} "
+        f"conn/s={result['connections_per_sec']:9.0f} sent/s={result['messages_sent_per_sec']:9.0f} "
+        f"deliv/s={result['deliveries_per_sec']:10.0f} p50={result['latency_p50_ms']:8.2f}ms "
+        f"p99={result['latency_p99_ms']:8.2f}ms p999={result['latency_p999_ms']:8.2f}ms"
+        + (" TIMEOUT" if result["timed_out"] else "")
+    )
+
+
+async def run_all(args, port: int, coalesce_ms: int = 0) -> list:
+    results = []
+    modes = {"encrypted": [True], "unencrypted": [False], "both": [True, False]}[args.mode]
+    run_id = itertools.count()
+    for encrypted, clients, size, slow, flooders in itertools.product(modes, args.clients, args.size, args.slow, args.flooders):
+        result = await run_scenario(
+            port, next(run_id), clients, size, slow, flooders, encrypted, args.binary,
+            args.senders, args.messages, args.flood_size, args.connect_concurrency, args.timeout,
+        )
+        result["coalesce_ms"] = coalesce_ms
+        print_result(result)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the Enigma server")
+    parser.add_argument("--clients", type=parse_list, default=[100], help="comma separated client counts")
+    parser.add_argument("--size", type=parse_list, default=[64], help="comma separated payload sizes in bytes")
+    parser.add_argument("--slow", type=parse_list, default=[0], help="comma separated slow consumer counts")
+    parser.add_argument("--flooders", type=parse_list, default=[0], help="comma separated counts of clients that send nonstop")
+    parser.add_argument("--flood-size", type=int, default=16384, help="payload size of the flooders' messages")
+    parser.add_argument("--senders", type=int, default=10, help="clients that send messages")
+    parser.add_argument("--messages", type=int, default=100, help="messages sent by each sender")
+    parser.add_argument("--mode", choices=("encrypted", "unencrypted", "both"), default="both")
+    parser.add_argument("--binary", action="store_true", help="negotiate the binary framing")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--uvloop", action="store_true", help="run the server with USE_UVLOOP=1")
+    parser.add_argument("--coalesce-ms", type=parse_list, default=[0], help="comma separated server WRITE_COALESCE_MS values")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="extra server setting")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for delivery per scenario")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    extra_env = dict(item.split("=", 1) for item in args.server_env)
+    if args.uvloop:
+        extra_env["USE_UVLOOP"] = "1"
+    results = []
+    # The coalesce window is a server setting, so each value gets its own server
+    for coalesce_ms in args.coalesce_ms:
+        port = free_port()
+        with start_server(port, args.workers, {**extra_env, "WRITE_COALESCE_MS": str(coalesce_ms)}):
+            for result in asyncio.run(run_all(args, port, coalesce_ms)):
+                results.append(result)
+
+    if args.output:
+        report = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "workers": args.workers,
+            "server_env": extra_env,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
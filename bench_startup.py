@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+
+# Cold-start benchmark for client.py. Every run is a fresh interpreter in an
+# empty scratch directory, so nothing is warm in the process and no .env is
+# picked up. "import" is `import client`, "start" runs the app headless
+# until the start screen is up and exits. Exits non-zero when a median is
+# over its budget, so it can guard startup time in CI.
+#
+#   python bench_startup.py --runs 20 --importtime 15
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = {
+    "import": "import client\n",
+    "start": (
+        "import client\n"
+        "async def ready(pilot):\n"
+        "    pilot.app.exit()\n"
+        "client.Client().run(headless=True, auto_pilot=ready)\n"
+    ),
+}
+# Peak RSS of the child, ru_maxrss is in bytes on macOS and KiB elsewhere
+REPORT_RSS = (
+    "import resource, sys\n"
+    "rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+    "print(rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024)\n"
+)
+
+
+def child_env() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = HERE + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def run_once(code: str, cwd: str) -> tuple[float, float]:
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code + REPORT_RSS], cwd=cwd, env=child_env(),
+        capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"exited with {result.returncode}")
+    return elapsed, float(result.stdout.split()[-1])
+
+
+def measure(name: str, runs: int, cwd: str) -> dict:
+    # The first run only warms the OS file cache and is not counted
+    run_once(SCENARIOS[name], cwd)
+    times, rss = [], []
+    for _ in range(runs):
+        elapsed, peak = run_once(SCENARIOS[name], cwd)
+        times.append(elapsed * 1000)
+        rss.append(peak)
+    times.sort()
+    return {
+        "scenario": name,
+        "runs": runs,
+        "median_ms": round(statistics.median(times), 1),
+        "p90_ms": round(times[min(len(times) - 1, int(len(times) * 0.9))], 1),
+        "min_ms": round(times[0], 1),
+        "rss_mb": round(statistics.median(rss), 1),
+    }
+
+
+def slowest_imports(cwd: str, limit: int) -> list:
+    # Cumulative import time of the modules client.py pulls in directly
+    # and their direct imports, from `python -X importtime`
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import client"], cwd=cwd, env=child_env(),
+        capture_output=True, text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth <= 2:
+            modules.append((int(cumulative) / 1000, name.strip()))
+    return sorted(modules, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for the Enigma client")
+    parser.add_argument("--runs", type=int, default=10, help="measured runs per scenario")
+    parser.add_argument("--import-budget-ms", type=float, default=500, help="fail if the median import is slower, 0 to skip")
+    parser.add_argument("--start-budget-ms", type=float, default=1000, help="fail if the median start is slower, 0 to skip")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    budgets = {"import": args.import_budget_ms, "start": args.start_budget_ms}
+    results = []
+    over = []
+    with tempfile.TemporaryDirectory(prefix="enigma-startup-") as scratch:
+        for name in SCENARIOS:
+            result = measure(name, args.runs, scratch)
+            result["budget_ms"] = budgets[name]
+            results.append(result)
+            print(
+                f"{name:<7} median {result['median_ms']:7.1f} ms  p90 {result['p90_ms']:7.1f} ms  "
+                f"min {result['min_ms']:7.1f} ms  rss {result['rss_mb']:6.1f} MB  (budget {budgets[name]:g} ms)"
+            )
+            if budgets[name] and result["median_ms"] > budgets[name]:
+                over.append(name)
+        if os.path.exists(os.path.join(scratch, ".env")):
+            print("warning: the client wrote a .env file while starting")
+        if args.importtime:
+            print("\nslowest imports (cumulative ms):")
+            for ms, module in slowest_imports(scratch, args.importtime):
+                print(f"  {ms:8.1f}  {module}")
+
+    if args.output:
+        report = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if over:
+        print(f"over budget: {', '.join(over)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import socket
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+# Bus lines carry whole client frames, JSON-escaped a second time
+LINE_LIMIT = 2 ** 24
+# Bytes queued for one peer before its broadcasts are dropped, at twice
+# this the peer is disconnected
+QUEUE_BYTES = 2 * LINE_LIMIT
+# Errors writing to a peer that went away, expected while shutting down
+# or restarting
+PEER_GONE = (BrokenPipeError, ConnectionResetError)
+
+
+# Local message bus for --workers mode. The master process runs the Hub on a
+# Unix-domain socket, every worker connects with a BusClient. The hub owns
+# username claims so names stay unique across workers, and forwards
+# broadcasts, presence and room membership changes to every other worker.
+
+def encode(message: dict) -> bytes:
+    return (json.dumps(message) + "\n").encode()
+
+
+def bind_unix(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
+
+
+# The sending side of one bus connection. Lines are queued and written by
+# a task that waits for drain(), so a slow or stuck peer holds up neither
+# the caller nor the other peers. Past max_bytes queued, broadcasts to it
+# are dropped like chat to a slow client, while claims and presence
+# changes are always kept since the peer would be out of step without
+# them. A peer that gets twice max_bytes behind is disconnected
+
+class BusPeer:
+    def __init__(self, writer: asyncio.StreamWriter, max_bytes: int = QUEUE_BYTES):
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.queued = 0
+        self.dropped = 0
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.write_loop())
+
+    def send(self, line: bytes, droppable: bool = False) -> bool:
+        if self.closed:
+            return False
+        if droppable and self.queued >= self.max_bytes:
+            if not self.dropped:
+                logger.warning("Bus peer is behind, dropping broadcasts to it")
+            self.dropped += 1
+            return False
+        if self.queued >= 2 * self.max_bytes:
+            logger.error("Bus peer is %d bytes behind, disconnecting it", self.queued)
+            self.abort()
+            return False
+        self.queue.append(line)
+        self.queued += len(line)
+        self.wakeup.set()
+        return True
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    batch = list(self.queue)
+                    self.queue.clear()
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+                    self.queued -= sum(map(len, batch))
+                if self.dropped:
+                    logger.warning("Bus peer caught up, %d broadcasts were dropped", self.dropped)
+                    self.dropped = 0
+        except asyncio.CancelledError:
+            pass
+        except PEER_GONE:
+            self.abort()
+
+    def abort(self):
+        self.closed = True
+        self.queue.clear()
+        self.queued = 0
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.writer.transport.abort()
+
+    async def close(self):
+        self.closed = True
+        self.task.cancel()
+        with contextlib.suppress(*PEER_GONE):
+            self.writer.close()
+            await self.writer.wait_closed()
+
+
+class Hub:
+    def __init__(self, expected: int = 0, on_ready=None):
+        # on_ready runs once `expected` workers have reported they are listening
+        self.workers = {}
+        self.names = {}
+        self.members = {}
+        self.expected = expected
+        self.on_ready = on_ready
+        self.ready = 0
+
+    async def serve(self, sock: socket.socket):
+        server = await asyncio.start_unix_server(self.handle_worker, sock=sock, limit=LINE_LIMIT)
+        async with server:
+            await server.serve_forever()
+
+    def forward(self, line: bytes, source=None, droppable: bool = False):
+        for worker in self.workers:
+            if worker is not source:
+                worker.send(line, droppable)
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = BusPeer(writer)
+        claimed = self.workers[peer] = set()
+        entered = set()
+        # Tell the new worker who is already online elsewhere, and in which rooms
+        for (encrypted, _), (_, name) in self.names.items():
+            peer.send(encode({"op": "join", "encrypted": encrypted, "name": name}))
+        for (encrypted, room, _), name in self.members.items():
+            peer.send(encode({"op": "enter", "encrypted": encrypted, "room": room, "name": name}))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                message = json.loads(line)
+                op = message["op"]
+                if op == "broadcast":
+                    self.forward(line, peer, droppable=True)
+                elif op == "ready":
+                    self.ready += 1
+                    if self.ready == self.expected and self.on_ready is not None:
+                        self.on_ready()
+                elif op == "claim":
+                    key = (message["encrypted"], message["name"].casefold())
+                    ok = key not in self.names
+                    if ok:
+                        self.names[key] = (peer, message["name"])
+                        claimed.add(key)
+                        self.forward(encode({"op": "join", "encrypted": message["encrypted"], "name": message["name"]}), peer)
+                    peer.send(encode({"op": "claimed", "id": message["id"], "ok": ok}))
+                elif op == "release":
+                    key = (message["encrypted"], message["name"].casefold())
+                    if key in claimed:
+                        claimed.discard(key)
+                        self.release(key, peer)
+                elif op == "enter":
+                    key = (message["encrypted"], message["room"], message["name"].casefold())
+                    if key not in self.members:
+                        self.members[key] = message["name"]
+                        entered.add(key)
+                        self.forward(line, peer)
+                elif op == "exit":
+                    key = (message["encrypted"], message["room"], message["name"].casefold())
+                    if key in entered:
+                        entered.discard(key)
+                        self.exit(key, peer)
+        except (asyncio.CancelledError, *PEER_GONE):
+            # Shutting down or the worker exited, returning keeps asyncio
+            # from logging the cancel
+            pass
+        except Exception as e:
+            logger.error("Bus error: %s", e)
+        finally:
+            del self.workers[peer]
+            for key in entered:
+                self.exit(key, peer)
+            for key in claimed:
+                self.release(key, peer)
+            await peer.close()
+
+    def release(self, key, source):
+        _, name = self.names.pop(key)
+        self.forward(encode({"op": "leave", "encrypted": key[0], "name": name}), source)
+
+    def exit(self, key, source):
+        name = self.members.pop(key)
+        self.forward(encode({"op": "exit", "encrypted": key[0], "room": key[1], "name": name}), source)
+
+
+class BusClient:
+    def __init__(self, on_broadcast, on_join, on_leave, on_enter, on_exit):
+        self.on_broadcast = on_broadcast
+        self.on_join = on_join
+        self.on_leave = on_leave
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self.pending = {}
+        self.ids = itertools.count()
+        self.reader = None
+        self.peer = None
+        self.task = None
+
+    async def connect(self, path: str):
+        self.reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        self.peer = BusPeer(writer)
+        self.task = asyncio.create_task(self.read_loop())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.peer is not None:
+            await self.peer.close()
+
+    async def read_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Lost connection to the worker bus")
+            message = json.loads(line)
+            op = message["op"]
+            if op == "broadcast":
+                self.on_broadcast(message["encrypted"], message["room"], message["frame"].encode())
+            elif op == "join":
+                self.on_join(message["encrypted"], message["name"])
+            elif op == "leave":
+                self.on_leave(message["encrypted"], message["name"])
+            elif op == "enter":
+                self.on_enter(message["encrypted"], message["room"], message["name"])
+            elif op == "exit":
+                self.on_exit(message["encrypted"], message["room"], message["name"])
+            elif op == "claimed":
+                future = self.pending.pop(message["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(message["ok"])
+
+    async def claim(self, encrypted: bool, name: str) -> bool:
+        request_id = next(self.ids)
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        self.peer.send(encode({"op": "claim", "id": request_id, "encrypted": encrypted, "name": name}))
+        return await future
+
+    def release(self, encrypted: bool, name: str):
+        self.peer.send(encode({"op": "release", "encrypted": encrypted, "name": name}))
+
+    def ready(self):
+        self.peer.send(encode({"op": "ready"}))
+
+    def enter(self, encrypted: bool, room: str, name: str):
+        self.peer.send(encode({"op": "enter", "encrypted": encrypted, "room": room, "name": name}))
+
+    def exit(self, encrypted: bool, room: str, name: str):
+        self.peer.send(encode({"op": "exit", "encrypted": encrypted, "room": room, "name": name}))
+
+    def publish(self, encrypted: bool, room: str, data: bytes):
+        self.peer.send(encode({"op": "broadcast", "encrypted": encrypted, "room": room, "frame": data.decode()}), droppable=True)
@@ -0,0 +1,577 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from tuning import tune_socket
+from protocol import PROTOCOL_VERSION, KIND_TOKEN, chat_packet, encode_message, read_frame
+
+
+# Headless Enigma client: the handshake, reconnects, presence and
+# encryption without any UI, for bots, bridges and load clients. Received
+# messages come out of `async for event in client`. Sends are queued and
+# written by one task, which encrypts everything waiting in one executor
+# call and sends it with one writelines and drain. Many clients can run in
+# one process, they share the crypto thread pool.
+#
+#     client = ChatClient("localhost", 8000, "bot", key)
+#     await client.connect()
+#     client.send_nowait("hello")
+#     async for event in client:
+#         if event.type == "message":
+#             print(event.username, event.text)
+
+# The server's default frame limit. Large messages are split so that every
+# chunk still fits once it is encrypted and encoded
+MAX_FRAME_BYTES = 65536
+# Kept free for what the server adds when relaying a message, its
+# sequence number or the room of a chunk, so recipients can read it too
+RELAY_BYTES = 128
+
+_pool = None
+
+
+@lru_cache(maxsize=8)
+def get_fernet(key: str) -> "Fernet":
+    from cryptography.fernet import Fernet
+    return Fernet(key.encode())
+
+
+def get_crypto_pool(workers: int = 1) -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(workers, thread_name_prefix="enigma-crypto")
+    return _pool
+
+
+def payload_bytes(text: str, encrypted: bool) -> int:
+    # Size of text as a payload on the wire: a Fernet token (57 bytes of
+    # header and HMAC around the padded ciphertext, base64'd) when
+    # encrypted, otherwise a JSON string, where a character outside the BMP
+    # is escaped to 12 bytes
+    if encrypted:
+        ciphertext = (len(text.encode()) // 16 + 1) * 16
+        return -(-(57 + ciphertext) // 3) * 4
+    return len(json.dumps(text)) - 2
+
+
+def split_payload(text: str, budget: int, encrypted: bool) -> list:
+    # The longest pieces whose payload fits in budget bytes, found by
+    # bisecting. Every character takes at least a byte, so a piece is never
+    # longer than the budget
+    if budget < 64:
+        raise ValueError(f"{budget} bytes is too small for a chunk")
+    pieces = []
+    start = 0
+    while start < len(text) or not pieces:
+        low, high = start + 1, min(len(text), start + budget)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if payload_bytes(text[start:middle], encrypted) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(text[start:low])
+        start = low
+    return pieces
+
+
+def encrypt_batch(fernet: "Fernet", texts: list) -> list:
+    # A text that cannot be encrypted comes back as its exception, so one
+    # bad message does not fail the others
+    tokens = []
+    for text in texts:
+        try:
+            tokens.append(fernet.encrypt(text.encode()))
+        except Exception as e:
+            tokens.append(e)
+    return tokens
+
+
+def decrypt_batch(fernet: "Fernet", tokens: list) -> tuple[list, float]:
+    # Runs in the crypto pool, returns the texts and the total time spent
+    started = time.perf_counter()
+    texts = []
+    for token in tokens:
+        try:
+            texts.append(fernet.decrypt(token.encode()).decode())
+        except Exception:
+            texts.append("Decryption failed")
+    return texts, time.perf_counter() - started
+
+
+class DecryptStats:
+    __slots__ = ("count", "total", "last")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+
+    def record(self, count: int, elapsed: float):
+        if count:
+            self.count += count
+            self.total += elapsed
+            self.last = elapsed / count
+
+    def __str__(self):
+        if not self.count:
+            return ""
+        return f"decrypt {self.last * 1e6:.0f}µs/msg (avg {self.total / self.count * 1e6:.0f}µs over {self.count})"
+
+
+# Event types: "message" (chat from another user, text decrypted), "chunk"
+# (one piece of a large message, data has its "id", "index" and "final" or
+# "aborted"), "system" (server notices, and "N messages skipped" with data
+# {"skipped": N} when max_backlog drops older messages), "users" (presence
+# changed, see ChatClient.users),
+# "disconnected", "reconnecting", "connected" (after a reconnect) and
+# "closed" (gave up reconnecting). `data` is the raw message when there is one
+
+class Event:
+    __slots__ = ("type", "text", "username", "room", "seq", "data")
+
+    def __init__(self, type: str, text: str = "", username: str = None, room: str = None, seq: int = None, data: dict = None):
+        self.type = type
+        self.text = text
+        self.username = username
+        self.room = room
+        self.seq = seq
+        self.data = data
+
+
+class ChatClient:
+    def __init__(self, host: str, port: int, username: str, key: str = None, encrypted: bool = True,
+                 binary: bool = True, reconnect: bool = True, reconnect_base_delay: float = 0.5,
+                 reconnect_max_delay: float = 30, reconnect_attempts: int = 0, max_pending: int = 100,
+                 max_backlog: int = 0, stream_limit: int = 65536, rcvbuf: int = 0, crypto_workers: int = 1,
+                 max_frame_bytes: int = MAX_FRAME_BYTES):
+        self.host = host
+        self.port = port
+        self.username = username
+        if encrypted and not key:
+            raise ValueError("An encrypted client needs a key")
+        self.encrypted = encrypted
+        self.fernet = get_fernet(key) if encrypted else None
+        self.want_binary = binary
+        self.binary = False
+        self.auto_reconnect = reconnect
+        self.reconnect_base_delay = reconnect_base_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_attempts = reconnect_attempts
+        self.stream_limit = stream_limit
+        self.max_frame_bytes = max_frame_bytes
+        self.rcvbuf = rcvbuf
+        self.crypto_pool = get_crypto_pool(crypto_workers)
+        self.crypto_workers = crypto_workers
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.connections = 0
+        self.closed = False
+        self.last_seq = None
+        self.reconnect_in = None
+        self.decrypt_stats = DecryptStats()
+        # Presence per room: user list and the version it is at
+        self.rooms = {}
+        self.joined = set()
+        self.resync_pending = set()
+        # Outgoing (text, room, extra fields), oldest dropped by send_nowait when full
+        self.outgoing = deque()
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self.dropped = 0
+        self.send_ready = asyncio.Event()
+        self.send_space = asyncio.Event()
+        self.send_space.set()
+        self.sent = asyncio.Event()
+        self.sent.set()
+        # Received events in order, chat ones wait for decryption with their token
+        self.incoming = []
+        self.incoming_ready = asyncio.Event()
+        self.events = deque()
+        self.events_ready = asyncio.Event()
+        self.tasks = []
+        self.reading = None
+        self.reconnecting = None
+
+    @property
+    def pending(self) -> int:
+        # Received but not yet handed out by the iterator
+        return len(self.incoming) + len(self.events)
+
+    def users(self, room: str = None) -> list:
+        if room is None:
+            room = next(iter(self.rooms), None)
+        return self.rooms.get(room, ([], None))[0]
+
+    async def connect(self):
+        # Open the socket and do the handshake, raises ConnectionRefusedError
+        # when the server turns us away
+        reader, writer = await asyncio.open_connection(self.host, self.port, limit=self.stream_limit)
+        try:
+            tune_socket(writer.get_extra_info("socket"), rcvbuf=self.rcvbuf)
+            handshake = {"username": self.username, "encrypted": self.encrypted, "version": PROTOCOL_VERSION}
+            if self.want_binary:
+                handshake["framing"] = ["binary"]
+            if self.last_seq is not None:
+                handshake["since"] = self.last_seq
+            writer.write((json.dumps(handshake) + "\n").encode())
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("No response from server during handshake")
+            message = json.loads(line.decode())
+            if not message.get("text", "").startswith("Connected as"):
+                raise ConnectionRefusedError(message.get("text", "Handshake rejected"))
+        except BaseException:
+            writer.close()
+            raise
+        self.reader, self.writer = reader, writer
+        # Older servers ignore the version and keep talking JSON lines
+        self.binary = message.get("framing") == "binary"
+        if self.last_seq is None and isinstance(message.get("seq"), int):
+            self.last_seq = message["seq"]
+        self.connected = True
+        self.connections += 1
+        # The server sends fresh snapshots, and rooms joined after the
+        # handshake have to be joined again on a new connection
+        self.rooms.clear()
+        self.resync_pending.clear()
+        for room in self.joined:
+            self.command({"type": "join", "room": room})
+        self.reading = asyncio.create_task(self.read_loop())
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.write_loop()), asyncio.create_task(self.decode_loop())]
+        self.send_ready.set()
+
+    async def close(self):
+        self.closed = True
+        self.connected = False
+        for task in [self.reading, self.reconnecting, *self.tasks]:
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._close_writer()
+        self.events_ready.set()
+
+    # Sending
+
+    def send_nowait(self, text: str, room: str = None):
+        # Queued even while disconnected, the oldest is dropped when full
+        if len(self.outgoing) >= self.max_pending:
+            self.outgoing.popleft()
+            self.dropped += 1
+        self._queue(text, room)
+
+    async def send(self, text: str, room: str = None):
+        # Waits for space in the queue instead of dropping
+        await self._wait_space()
+        self._queue(text, room)
+
+    def fits_frame(self, text: str, room: str = None) -> bool:
+        # Whether text can be sent as one message, otherwise use send_large
+        return len(self._encode("", room)) + payload_bytes(text, self.encrypted) <= self.max_frame_bytes - RELAY_BYTES
+
+    async def send_large(self, text: str, room: str = None, name: str = None) -> str:
+        # Sent as a chunked transfer that recipients get piece by piece. The
+        # chunks go through the send queue, so this waits whenever
+        # max_pending of them are queued. The server drops a transfer when
+        # the connection does, that raises ConnectionError here
+        transfer_id = os.urandom(8).hex()
+        connection = self.connections
+        # Every field a chunk can carry, with the largest index it could have
+        fields = {"type": "chunk", "id": transfer_id, "index": len(text), "size": len(text), "final": True}
+        if name is not None:
+            fields["name"] = name
+        budget = self.max_frame_bytes - RELAY_BYTES - len(self._encode("", room, fields))
+        pieces = split_payload(text, budget, self.encrypted)
+        count = len(pieces)
+        for index, piece in enumerate(pieces):
+            await self._wait_space()
+            if self.connections != connection or not self.connected:
+                raise ConnectionError(f"Connection lost during transfer {transfer_id}")
+            extra = {"type": "chunk", "id": transfer_id, "index": index}
+            if index == 0:
+                extra["size"] = len(text)
+                if name is not None:
+                    extra["name"] = name
+            if index == count - 1:
+                extra["final"] = True
+            self._queue(piece, room, extra)
+        return transfer_id
+
+    async def flush(self):
+        # Wait until everything queued so far has been written
+        await self.sent.wait()
+
+    def command(self, message: dict):
+        # join / leave / rooms / resync / history, written right away
+        if self.writer is not None:
+            self.writer.write(encode_message(message, self.binary))
+
+    def join(self, room: str):
+        self.joined.add(room)
+        self.command({"type": "join", "room": room})
+
+    def leave(self, room: str):
+        self.joined.discard(room)
+        self.rooms.pop(room, None)
+        self.command({"type": "leave", "room": room})
+
+    async def _wait_space(self):
+        while len(self.outgoing) >= self.max_pending:
+            self.send_space.clear()
+            await self.send_space.wait()
+
+    def _queue(self, text: str, room: str, extra: dict = None):
+        self.outgoing.append((text, room, extra))
+        self.sent.clear()
+        self.send_ready.set()
+
+    async def write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.send_ready.wait()
+            self.send_ready.clear()
+            if not self.connected or not self.outgoing:
+                if not self.outgoing:
+                    self.sent.set()
+                continue
+            batch = list(self.outgoing)
+            self.outgoing.clear()
+            self.send_space.set()
+            if self.encrypted:
+                tokens = await loop.run_in_executor(self.crypto_pool, encrypt_batch, self.fernet, [text for text, _, _ in batch])
+            else:
+                tokens = [None] * len(batch)
+            data = []
+            sendable = []
+            for token, item in zip(tokens, batch):
+                # A message that cannot be encoded is reported and dropped,
+                # sending it again would fail the same way
+                text, room, extra = item
+                try:
+                    if isinstance(token, Exception):
+                        raise token
+                    data.append(self._encode(text, room, extra) if token is None else self._encode_token(token, room, extra))
+                except Exception as e:
+                    self._emit(Event("system", f"Message not sent: {e}", room=room, data=extra))
+                    continue
+                sendable.append(item)
+            if self.writer is None:
+                # The connection dropped while the batch was being
+                # encrypted, unfinished transfers went with it
+                self.outgoing.extendleft(item for item in reversed(sendable) if item[2] is None)
+                continue
+            try:
+                self.writer.writelines(data)
+                await self.writer.drain()
+            except (ConnectionError, OSError) as e:
+                # Put them back in order, they go out after reconnecting
+                self.outgoing.extendleft(reversed(sendable))
+                self.connection_lost(str(e) or "connection closed")
+                continue
+            if self.outgoing:
+                self.send_ready.set()
+            else:
+                self.sent.set()
+
+    def _encode(self, payload: str, room: str, extra: dict = None) -> bytes:
+        message = {"username": self.username, "payload": payload}
+        if room is not None:
+            message["room"] = room
+        if extra is not None:
+            message.update(extra)
+        return encode_message(message, self.binary)
+
+    def _encode_token(self, token: bytes, room: str, extra: dict = None) -> bytes:
+        if self.binary and room is None and extra is None:
+            # Binary framing carries the raw token instead of its base64 text
+            return chat_packet(self.username, base64.urlsafe_b64decode(token), KIND_TOKEN)
+        return self._encode(token.decode(), room, extra)
+
+    # Receiving
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Event:
+        while not self.events:
+            if self.closed:
+                raise StopAsyncIteration
+            self.events_ready.clear()
+            await self.events_ready.wait()
+        return self.events.popleft()
+
+    def events_nowait(self) -> list:
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def _emit(self, event: Event, token: str = None):
+        # Everything goes through decode_loop so events keep their order
+        # while ciphertext is decrypted off the event loop
+        self.incoming.append((event, token))
+        self.incoming_ready.set()
+
+    async def read_loop(self):
+        while True:
+            try:
+                frame = await read_frame(self.reader, self.binary, self.stream_limit)
+            except (ConnectionError, OSError, EOFError) as e:
+                self.connection_lost(str(e) or "connection closed")
+                return
+            except Exception as e:
+                self._emit(Event("system", f"Error receiving message: {e}"))
+                continue
+            if frame is None:
+                self.connection_lost("connection closed")
+                return
+            try:
+                self.handle_message(frame.message)
+            except Exception as e:
+                self._emit(Event("system", f"Error receiving message: {e}"))
+
+    def handle_message(self, message: dict):
+        seq = message.get("seq")
+        if isinstance(seq, int):
+            self.last_seq = seq
+        room = message.get("room")
+        if message.get("system"):
+            text = message.get("text", "")
+            if message.get("presence") == "snapshot" or "users" in message:
+                self.rooms[room] = (message.get("users", []), message.get("version"))
+                self.resync_pending.discard(room)
+                self._emit(Event("users", text, room=room, data=message))
+            elif message.get("presence") == "delta":
+                self.apply_presence_delta(room, message)
+                self._emit(Event("users", text, room=room, data=message))
+            else:
+                if message.get("restart") and isinstance(message.get("reconnect_in"), (int, float)):
+                    self.reconnect_in = message["reconnect_in"]
+                self._emit(Event("system", text, room=room, seq=seq, data=message))
+            return
+        if message.get("type") == "chunk":
+            payload = message.get("payload")
+            event = Event("chunk", payload or message.get("text", ""), message.get("username"), room, seq, message)
+            self._emit(event, payload if self.encrypted else None)
+            return
+        payload = message.get("payload", "")
+        event = Event("message", payload, message.get("username", "Unknown"), room, seq, message)
+        self._emit(event, payload if self.encrypted else None)
+
+    def apply_presence_delta(self, room: str, message: dict):
+        # A delta only applies on top of the version we hold, otherwise ask
+        # the server for a fresh snapshot
+        users, version = self.rooms.get(room, (None, None))
+        if users is None or message.get("base") != version:
+            if room not in self.resync_pending:
+                self.resync_pending.add(room)
+                self.command({"type": "resync", "room": room} if room is not None else {"type": "resync"})
+            return
+        left = set(message.get("left", []))
+        users = [u for u in users if u not in left] + message.get("joined", [])
+        self.rooms[room] = (users, message.get("version"))
+
+    async def decode_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.incoming_ready.wait()
+            self.incoming_ready.clear()
+            batch = self.incoming
+            self.incoming = []
+            # A consumer that only keeps the last max_backlog messages (like
+            # a scrollback) never pays for decrypting the older ones. Only
+            # chat lines are skipped, a marker takes the place of the first
+            # one, every other event is always delivered
+            skip = sum(1 for event, _ in batch if event.type == "message") - self.max_backlog
+            if self.max_backlog and skip > 0:
+                batch = self._skip_messages(batch, skip)
+            pending = [(event, token) for event, token in batch if token is not None]
+            if pending and self.fernet is None:
+                for event, _ in pending:
+                    event.text = "Decryption failed"
+            elif pending:
+                tokens = [token for _, token in pending]
+                size = -(-len(tokens) // self.crypto_workers)
+                chunks = [tokens[i:i + size] for i in range(0, len(tokens), size)]
+                results = await asyncio.gather(*(
+                    loop.run_in_executor(self.crypto_pool, decrypt_batch, self.fernet, chunk) for chunk in chunks
+                ))
+                texts = [text for chunk_texts, _ in results for text in chunk_texts]
+                for (event, _), text in zip(pending, texts):
+                    event.text = text
+                self.decrypt_stats.record(len(tokens), sum(elapsed for _, elapsed in results))
+            self.events.extend(event for event, _ in batch)
+            self.events_ready.set()
+
+    @staticmethod
+    def _skip_messages(batch: list, skip: int) -> list:
+        kept = []
+        marker = Event("system", f"{skip} messages skipped", data={"skipped": skip})
+        for event, token in batch:
+            if event.type == "message" and skip:
+                if skip == marker.data["skipped"]:
+                    kept.append((marker, None))
+                skip -= 1
+                continue
+            kept.append((event, token))
+        return kept
+
+    # Reconnecting
+
+    def connection_lost(self, reason: str):
+        if self.closed or self.reconnecting or not self.connected:
+            return
+        self.connected = False
+        self._close_writer()
+        # The server drops unfinished transfers with the connection
+        self.outgoing = deque(item for item in self.outgoing if item[2] is None)
+        self.send_space.set()
+        self._emit(Event("disconnected", reason))
+        if self.auto_reconnect:
+            self.reconnecting = asyncio.create_task(self.reconnect())
+        else:
+            self.closed = True
+            self._emit(Event("closed", reason))
+
+    async def reconnect(self):
+        # Jittered exponential backoff, resuming from the last seq we saw
+        attempt = 0
+        try:
+            while not self.closed:
+                attempt += 1
+                if self.reconnect_attempts and attempt > self.reconnect_attempts:
+                    self.closed = True
+                    self._emit(Event("closed", "Could not reconnect to server"))
+                    return
+                if attempt == 1 and self.reconnect_in is not None:
+                    # The server is restarting: spread reconnects over the
+                    # window it asked for instead of all arriving at once
+                    delay = random.uniform(0, self.reconnect_in)
+                    self.reconnect_in = None
+                else:
+                    delay = random.uniform(0, min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** attempt))
+                self._emit(Event("reconnecting", f"Reconnecting in {delay:.1f}s (attempt {attempt})"))
+                await asyncio.sleep(delay)
+                try:
+                    await self.connect()
+                except Exception as e:
+                    self._emit(Event("reconnecting", f"Reconnect failed: {e}"))
+                    continue
+                self._emit(Event("connected", "Reconnected"))
+                return
+        finally:
+            self.reconnecting = None
+
+    def _close_writer(self):
+        if self.reading is not None and self.reading is not asyncio.current_task():
+            self.reading.cancel()
+        self.reading = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
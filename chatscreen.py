@@ -0,0 +1,303 @@
+import asyncio
+import contextlib
+import os
+from collections import deque
+from datetime import datetime
+from textual.widgets import Input, Static, Button, RichLog
+from textual.scroll_view import ScrollView
+from textual.screen import Screen
+from textual.containers import Vertical, Horizontal
+from rich.text import Text
+from chatclient import ChatClient
+
+
+# The chat screen lives in its own module so the start screen can come up
+# without importing it, the networking and crypto behind it, or RichLog.
+# client.py has loaded .env by the time this is imported
+
+STREAM_LIMIT = int(os.getenv("STREAM_LIMIT") or 65536)
+MAX_FRAME_BYTES = int(os.getenv("MAX_FRAME_BYTES") or 65536)
+SOCKET_RCVBUF = int(os.getenv("SOCKET_RCVBUF") or 0)
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE") or 2000)
+UI_MAX_FPS = float(os.getenv("UI_MAX_FPS") or 30)
+MAX_LINES_PER_FRAME = int(os.getenv("MAX_LINES_PER_FRAME") or 500)
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS") or 1)
+RECONNECT_BASE_DELAY = float(os.getenv("RECONNECT_BASE_DELAY") or 0.5)
+RECONNECT_MAX_DELAY = float(os.getenv("RECONNECT_MAX_DELAY") or 30)
+RECONNECT_ATTEMPTS = int(os.getenv("RECONNECT_ATTEMPTS") or 0)
+OUTBOX_SIZE = int(os.getenv("OUTBOX_SIZE") or 100)
+
+
+# One chat line, formatted once and kept for as long as it is in history
+
+class ChatLine:
+    __slots__ = ("timestamp", "sender", "text", "style", "_rendered")
+
+    def __init__(self, timestamp: str, sender: str, text: str, style: str):
+        self.timestamp = timestamp
+        self.sender = sender
+        self.text = text
+        self.style = style
+        self._rendered = None
+
+    def render(self) -> Text:
+        if self._rendered is not None:
+            return self._rendered
+        line = Text()
+        line.append(f"[{self.timestamp}] ", style="#00ff73")
+
+        if self.sender == "system":
+            line.append("[System] ", style="#001aff")
+            if self.style == "error":
+                line.append("[ERROR] ", style="#ff0000")
+            elif self.style == "success":
+                line.append("[OK] ", style="#00ff73")
+        else:
+            if self.style == "self":
+                line.append(f"You: ", style="#eeff00")
+            else:
+                line.append(f"{self.sender}: ", style="#00ffd5")
+
+        line.append(f" {str(self.text)}", style="#00FF22")
+        self._rendered = line
+        return line
+
+
+# Ring buffer of the last HISTORY_SIZE messages on top of RichLog, which only
+# lays out the rows that are visible. New lines are appended, never re-rendered
+
+class ChatLog(RichLog):
+    def __init__(self, history_size: int = HISTORY_SIZE, **kwargs):
+        super().__init__(wrap=True, markup=False, auto_scroll=False, max_lines=history_size, **kwargs)
+        self.history = deque(maxlen=history_size)
+        self.reflow_width = None
+
+    def append(self, line: ChatLine):
+        self.history.append(line)
+        # Only follow new messages if the user has not scrolled back
+        self.write(line.render(), scroll_end=self.is_vertical_scroll_end)
+
+    def on_resize(self, event) -> None:
+        # Wrapping depends on the width, so re-wrap the cached lines when it changes
+        width = event.size.width
+        if self.reflow_width is not None and width != self.reflow_width and self.history:
+            self.clear()
+            for line in self.history:
+                self.write(line.render(), scroll_end=False)
+            self.scroll_end(animate=False)
+        self.reflow_width = width
+
+
+# This is the Chat Screen, a view on top of a ChatClient
+
+class ChatScreen(Screen):
+    CSS_PATH = "appcss.css"
+
+    def __init__(self):
+        super().__init__()
+        self.unrendered = []
+        self.client = None
+        self.username = None
+        self.encrypted = True
+        self.events = None
+        self.users_dirty = False
+        # What the status line shows, it is only updated when this changes
+        self.status_text = ""
+        self.behind = 0
+        # Large messages being received: (sender, id) -> chunks so far
+        self.transfers = {}
+
+    def compose(self):
+        mode = "Encrypted" if self.encrypted else "Unencrypted"
+        status = "Connected" if not self.client else "Disconnected"
+        header = Static(f"{status} to Enigma 4000 in {mode} Mode", classes="header") # Top Banner
+        self.chat_log = ChatLog(classes="chat-messages")
+        self.status = Static("", classes="status")
+        self.activeusers = Static("")
+        self.active = ScrollView(self.activeusers, classes="active-users")
+        self.input_box = Input(placeholder="Type your message and press Enter...")
+        self.goback = Button("Disconnect / Go Back to Start", id="goback", variant="success")
+
+        yield Vertical(
+            header,
+            self.status,
+            Horizontal(
+                self.chat_log,
+                self.active,
+                classes="chat-layout"
+            ),
+            Horizontal(
+            self.input_box,
+            self.goback,
+            classes="input-layout"
+            )
+        )
+    async def on_mount(self) -> None:
+        # Filled in by the start screen, from its inputs or the .env defaults
+        cfg = self.app.user_config
+
+        self.username = cfg["username"]
+        # Lines older than the scrollback are dropped before they are decrypted
+        self.client = ChatClient(
+            cfg["host"], cfg["port"], self.username, cfg.get("key"), self.encrypted,
+            reconnect_base_delay=RECONNECT_BASE_DELAY,
+            reconnect_max_delay=RECONNECT_MAX_DELAY,
+            reconnect_attempts=RECONNECT_ATTEMPTS,
+            max_pending=OUTBOX_SIZE,
+            max_backlog=HISTORY_SIZE,
+            stream_limit=STREAM_LIMIT,
+            max_frame_bytes=MAX_FRAME_BYTES,
+            rcvbuf=SOCKET_RCVBUF,
+            crypto_workers=CRYPTO_WORKERS,
+        )
+
+        self.input_box.focus()
+        # Events are only buffered, the screen repaints at most UI_MAX_FPS times a second
+        self.set_interval(1 / UI_MAX_FPS, self.refresh_messages)
+        asyncio.create_task(self.tryconnect())
+        
+    # Messages wait in self.unrendered until the next refresh_messages()
+
+    def add_system_message(self, text: str, style: str = "info"):
+        self.unrendered.append(ChatLine(self.timestamp(), "system", text, style))
+
+    def add_user_message(self, username: str, text: str, is_self: bool = False):
+        self.unrendered.append(ChatLine(self.timestamp(), username, text, "self" if is_self else "other"))
+
+    async def tryconnect(self):
+        try:
+            await self.client.connect()
+        except ConnectionRefusedError as e:
+            self.add_system_message(str(e), "error")
+            await self.refresh_messages()
+            self.app.push_screen("start")
+            self.app.notify(f"{e}", severity="error", timeout=2.0)
+            return
+        except Exception as e:
+            self.add_system_message(f"Offline mode - no server connection: {e}", "error")
+            await self.refresh_messages()
+            self.app.push_screen("start")
+            self.app.notify(f"Failed to connect to server {self.client.host}:{self.client.port} because of {e}", severity="error", timeout=3.0)
+            return
+        self.add_system_message("Handshake successful", "success")
+        await self.refresh_messages()
+        self.events = asyncio.create_task(self.event_loop())
+
+    async def event_loop(self):
+        async for event in self.client:
+            if event.type == "message":
+                # Our own lines only come back when history is replayed,
+                # they are already on screen
+                if event.username != self.username:
+                    self.add_user_message(event.username, event.text)
+            elif event.type == "chunk":
+                self.add_chunk(event)
+            elif event.type == "users":
+                if event.data.get("presence") == "delta":
+                    self.add_system_message(event.text)
+                self.users_dirty = True
+            elif event.type == "system":
+                self.add_system_message(event.text)
+            elif event.type == "disconnected":
+                self.add_system_message(f"Disconnected from server: {event.text}", "error")
+            elif event.type == "reconnecting":
+                self.add_system_message(event.text, "error")
+            elif event.type == "connected":
+                self.add_system_message(event.text, "success")
+            elif event.type == "closed":
+                self.app.push_screen("start")
+                self.app.notify(event.text, severity="error", timeout=3.0)
+
+    def add_chunk(self, event):
+        # A large message is shown once its last chunk is in
+        key = (event.username, event.data.get("id"))
+        if event.data.get("aborted"):
+            if self.transfers.pop(key, None) is not None:
+                self.add_system_message(f"Message from {event.username} was cut off", "error")
+            return
+        parts = self.transfers.setdefault(key, [])
+        parts.append(event.text)
+        if event.data.get("final"):
+            del self.transfers[key]
+            if event.username != self.username:
+                self.add_user_message(event.username, "".join(parts))
+
+    async def refresh_messages(self):
+        # Render one frame's worth of new messages, whatever is left over
+        # shows up as a "messages behind" counter until it is caught up.
+        # Anything older than the history cap would be trimmed right away.
+        # An idle screen does no work, Static.update() means a layout pass
+        if not self.unrendered and not self.users_dirty and not self.behind:
+            return
+        if len(self.unrendered) > HISTORY_SIZE:
+            del self.unrendered[:-HISTORY_SIZE]
+        batch = self.unrendered[:MAX_LINES_PER_FRAME]
+        del self.unrendered[:MAX_LINES_PER_FRAME]
+        for line in batch:
+            self.chat_log.append(line)
+        self.behind = len(self.unrendered) + (self.client.pending if self.client else 0)
+        status = [f"{self.behind} messages behind"] if self.behind else []
+        if self.client and self.client.decrypt_stats.count:
+            status.append(str(self.client.decrypt_stats))
+        status_text = "  |  ".join(status)
+        if status_text != self.status_text:
+            self.status_text = status_text
+            self.status.update(status_text)
+        if self.users_dirty:
+            self.users_dirty = False
+            await self.refresh_active_users()
+        
+    async def refresh_active_users(self):
+        active_users = self.client.users()
+        usernumber = str(len(active_users))
+        userlist = '\n'.join(active_users)
+        active_users_text = Text(f"Active Users ({usernumber}): \n{userlist}", style="#00eeff")
+        self.activeusers.update(active_users_text)
+        self.active.scroll_end(animate=False)
+        
+        
+    async def on_button_pressed(self, event: Button.Pressed) -> None:
+        if event.button.id == "goback":
+            self.app.push_screen("start")
+            await self.disconnect()
+
+    async def disconnect(self):
+        if self.client:
+            await self.client.close()
+        if self.events:
+            self.events.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.events
+            self.events = None
+        
+    async def handle_input(self, message: str):
+        if not message.strip():
+            return
+        # The client writes it as soon as it is connected, while reconnecting
+        # it waits in the client's queue and the oldest is dropped when full
+        if not self.client.fits_frame(message):
+            # Too big for one frame, it goes out as a chunked transfer
+            asyncio.create_task(self.send_large(message))
+        else:
+            self.client.send_nowait(message)
+        self.add_user_message("You", message, is_self=True)
+        if not self.client.connected:
+            self.add_system_message(f"Not connected, message queued ({len(self.client.outgoing)} waiting)", "error")
+        await self.refresh_messages()
+
+            
+    async def send_large(self, message: str):
+        try:
+            await self.client.send_large(message)
+        except ConnectionError as e:
+            self.add_system_message(f"Failed to send: {e}", "error")
+
+    async def on_input_submitted(self, event: Input.Submitted) -> None:
+        await self.handle_input(event.value)
+        self.input_box.value = ""
+
+    async def on_unmount(self) -> None:
+        await self.disconnect()
+    
+    def timestamp(self):
+        return datetime.now().strftime("%H:%M:%S")
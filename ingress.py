@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+# Fair scheduling of received frames across senders. Reader tasks only
+# parse frames and queue them per sender, one task handles the queues with
+# deficit round robin: every turn a sender may spend `quantum * weight`
+# bytes, so a sender of big frames gets the same share of bytes as one of
+# small frames instead of the same number of frames. A full queue blocks
+# the sender's reader, which stops reading from the socket and lets TCP
+# push back on the client
+
+class _Sender:
+    __slots__ = ("queue", "weight", "deficit", "space", "empty")
+
+    def __init__(self, weight: float):
+        self.queue = deque()
+        self.weight = weight
+        self.deficit = 0
+        self.space = asyncio.Event()
+        self.space.set()
+        self.empty = asyncio.Event()
+        self.empty.set()
+
+
+class Ingress:
+    def __init__(self, queue_size: int = 64, quantum: int = 4096, batch: int = 64):
+        # batch: frames handled before other tasks get the loop back
+        self.queue_size = queue_size
+        self.quantum = quantum
+        self.batch = batch
+        self.senders = {}
+        self.active = deque()
+        self.ready = asyncio.Event()
+
+    def __len__(self):
+        return sum(len(sender.queue) for sender in self.senders.values())
+
+    def add(self, key, weight: float = 1.0):
+        self.senders[key] = _Sender(weight)
+
+    def remove(self, key):
+        # Frames still queued are dropped with the sender
+        sender = self.senders.pop(key, None)
+        if sender is not None:
+            sender.queue.clear()
+            sender.space.set()
+            sender.empty.set()
+
+    async def wait_empty(self, key):
+        # Lets a sender that is done reading have its last frames handled
+        sender = self.senders.get(key)
+        if sender is not None:
+            await sender.empty.wait()
+
+    async def wait_idle(self):
+        # Every queue handled, including frames from senders that were
+        # waiting for space when the others emptied
+        while len(self):
+            await asyncio.gather(*(sender.empty.wait() for sender in list(self.senders.values())))
+            await asyncio.sleep(0)
+
+    def clear(self):
+        # Drops whatever is still queued and releases everyone waiting,
+        # for when run() is stopped
+        for key, sender in list(self.senders.items()):
+            for _, handler, args in sender.queue:
+                if handler == self._resolve:
+                    args[0].cancel()
+            self.remove(key)
+
+    async def submit(self, key, cost: int, handler, *args):
+        sender = self.senders[key]
+        while len(sender.queue) >= self.queue_size:
+            sender.space.clear()
+            await sender.space.wait()
+        if not sender.queue:
+            self.active.append(sender)
+            self.ready.set()
+            sender.empty.clear()
+        sender.queue.append((cost, handler, args))
+
+    async def call(self, key, cost: int, handler, *args):
+        # Like submit, but waits for the handler and returns its result
+        future = asyncio.get_running_loop().create_future()
+        await self.submit(key, cost, self._resolve, future, handler, args)
+        return await future
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, handler, args: tuple):
+        if future.done():
+            # The caller was cancelled
+            return
+        try:
+            result = handler(*args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    async def run(self):
+        handled = 0
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.active:
+                sender = self.active.popleft()
+                if not sender.queue:
+                    # Removed while it was waiting for its turn
+                    continue
+                sender.deficit += self.quantum * sender.weight
+                while sender.queue and sender.queue[0][0] <= sender.deficit:
+                    cost, handler, args = sender.queue.popleft()
+                    sender.deficit -= cost
+                    try:
+                        handler(*args)
+                    except Exception:
+                        logger.exception("Error handling a message")
+                    handled += 1
+                if len(sender.queue) < self.queue_size:
+                    sender.space.set()
+                if sender.queue:
+                    self.active.append(sender)
+                else:
+                    sender.deficit = 0
+                    sender.empty.set()
+                if handled >= self.batch:
+                    handled = 0
+                    await asyncio.sleep(0)
@@ -0,0 +1,16 @@
+import base64
+import os
+
+
+# Fernet keys are 32 random bytes in URL-safe base64. Making and checking
+# them does not need cryptography, which is only imported once a chat starts
+
+def generate_key() -> str:
+    return base64.urlsafe_b64encode(os.urandom(32)).decode()
+
+
+def is_valid_key(key: str) -> bool:
+    try:
+        return len(base64.urlsafe_b64decode(key.encode())) == 32
+    except ValueError:
+        return False
@@ -0,0 +1,126 @@
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+# Logging for the server. Log calls on the event loop only format the
+# record and put it on a bounded queue, a QueueListener thread does the
+# file and console writes. When the queue is full records are dropped and
+# counted instead of blocking the loop. Records logged with
+# extra={"sample": True} are high-frequency events (connects, joins,
+# disconnects) and only a LOG_SAMPLE_RATE fraction of them is kept.
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue, on_drop=None):
+        super().__init__(log_queue)
+        self.on_drop = on_drop
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.on_drop is not None:
+                self.on_drop()
+
+
+# The stock QueueListener.stop() puts its sentinel with put_nowait, which
+# raises queue.Full when the queue is full, and the bounded queue is full
+# exactly when logging is under load. Wait for the listener thread to make
+# room, and if it does not within `timeout` drop the oldest record instead
+
+class BoundedQueueListener(QueueListener):
+    def __init__(self, log_queue: queue.Queue, *handlers, timeout: float = 5):
+        super().__init__(log_queue, *handlers)
+        self.timeout = timeout
+
+    def enqueue_sentinel(self):
+        try:
+            self.queue.put(self._sentinel, timeout=self.timeout)
+            return
+        except queue.Full:
+            pass
+        while True:
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or not getattr(record, "sample", False):
+            return True
+        return random.random() < self.rate
+
+
+# Rolls over when the file reaches max_bytes or every `interval` seconds,
+# whichever comes first, keeping `backups` numbered old files
+
+class RotatingLogFile(RotatingFileHandler):
+    def __init__(self, path: str, max_bytes: int = 0, interval: float = 0, backups: int = 5):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def start_logging(path: str, level=logging.INFO, max_bytes: int = 0, interval: float = 0, backups: int = 5,
+                  json_format: bool = False, queue_size: int = 10000, sample_rate: float = 1.0,
+                  on_drop=None) -> BoundedQueueListener:
+    # Replaces the root handlers, call listener.stop() on shutdown to flush.
+    # Must be called after fork, the listener thread does not survive it
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    handlers = [RotatingLogFile(path, max_bytes, interval, backups), logging.StreamHandler(sys.stderr)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue, on_drop)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = BoundedQueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,163 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Minimal Prometheus style metrics. Counters and histograms are plain
+# attribute updates on the hot path, gauges are computed at scrape time.
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.value_snapshot() for metric in self.metrics}
+
+
+registry = Registry()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, registry: Registry = registry):
+        self.name = name
+        self.help = help
+        self.value = 0
+        registry.register(self)
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self) -> list:
+        return [f"{self.name} {self.value}"]
+
+    def value_snapshot(self):
+        return self.value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, function=None, registry: Registry = registry):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self) -> list:
+        return [f"{self.name} {self.get()}"]
+
+    def value_snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS, registry: Registry = registry):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        registry.register(self)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+    def value_snapshot(self):
+        return {"count": self.count, "sum": self.sum, "buckets": dict(zip(map(str, self.buckets), self.counts))}
+
+
+async def serve_metrics(host: str, port: int, registry: Registry = registry):
+    # Tiny HTTP endpoint, any GET returns the text exposition format
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    while True:
+        try:
+            server = await asyncio.start_server(handle, host, port)
+            break
+        except OSError as e:
+            # After a restart the old process may still hold the port for a moment
+            logger.warning("Metrics port %d unavailable, retrying: %s", port, e)
+            await asyncio.sleep(1)
+    logger.info("Metrics available on http://%s:%d/metrics", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def dump_snapshots(path: str, interval: float, registry: Registry = registry):
+    while True:
+        await asyncio.sleep(interval)
+        record = {"time": time.time(), "metrics": registry.snapshot()}
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+async def monitor_loop_lag(histogram: Histogram, gauge: Gauge, interval: float = 0.5):
+    # How late the loop wakes us up is how long other callbacks held it
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        histogram.observe(lag)
+        gauge.set(lag)
@@ -0,0 +1,94 @@
+import asyncio
+from protocol import Frame
+
+
+# Presence for one room: new members get a versioned snapshot, everyone
+# else gets user_joined/user_left deltas. Joins and leaves inside the same
+# window are folded into a single delta so login storms stay linear
+
+class Presence:
+    def __init__(self, registry, window: float = 0.25, room: str = None):
+        self.registry = registry
+        self.window = window
+        self.room = room
+        self.version = 0
+        self.joined = {}
+        self.left = {}
+        self.waiting = []
+        self.flush_handle = None
+
+    def join(self, conn, username: str):
+        # conn is None for users that joined on another worker
+        if username in self.left:
+            del self.left[username]
+        else:
+            self.joined[username] = None
+        if conn is not None:
+            self.waiting.append(conn)
+        self.schedule()
+
+    def leave(self, username: str):
+        if username in self.joined:
+            del self.joined[username]
+        else:
+            self.left[username] = None
+        self.schedule()
+
+    def resync(self, conn):
+        # Snapshots go out with the next flush so their version lines up
+        # with the deltas that follow
+        self.waiting.append(conn)
+        self.schedule()
+
+    def schedule(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        self.flush_handle = None
+        waiting = {conn for conn in self.waiting if conn in self.registry}
+        self.waiting.clear()
+        if self.joined or self.left:
+            base = self.version
+            self.version += 1
+            joined = list(self.joined)
+            left = list(self.left)
+            self.joined.clear()
+            self.left.clear()
+            frame = Frame.encode({
+                "system": True,
+                "text": describe(joined, left),
+                "presence": "delta",
+                "joined": joined,
+                "left": left,
+                "base": base,
+                "version": self.version,
+                "room": self.room,
+            })
+            for conn in self.registry:
+                if conn not in waiting:
+                    conn.send(frame)
+        if waiting:
+            frame = self.snapshot()
+            for conn in waiting:
+                conn.send(frame)
+
+    def snapshot(self) -> Frame:
+        return Frame.encode({
+            "system": True,
+            "text": "Current Users",
+            "users": self.registry.user_list(),
+            "presence": "snapshot",
+            "version": self.version,
+            "room": self.room,
+        }, kind=f"users:{self.room}")
+
+
+def describe(joined: list, left: list) -> str:
+    parts = []
+    for names, verb in ((joined, "joined"), (left, "left")):
+        if len(names) > 3:
+            parts.append(f"{len(names)} users {verb}")
+        elif names:
+            parts.append(f"{', '.join(names)} {verb}")
+    return "; ".join(parts)
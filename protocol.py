@@ -0,0 +1,197 @@
+import asyncio
+import base64
+import json
+import struct
+
+
+# Wire protocol. Version 1 is newline delimited JSON. Clients that send
+# "version": 3 and "framing": ["binary"] in their handshake switch to
+# length prefixed packets once the server confirms with "framing": "binary".
+#
+# Packet: kind (u8) | body length (u32) | body
+#   KIND_JSON   body is a JSON object
+#   KIND_CHAT   body is seq (u64) | name length (u8) | username | UTF-8 text payload
+#   KIND_TOKEN  same as KIND_CHAT but the payload is a raw Fernet token,
+#               so ciphertext is not base64'd and then JSON-escaped again
+#
+# seq is the server's message store sequence number, 0 when there is none
+# (always 0 from clients). Version 2 chat packets had no seq field.
+
+PROTOCOL_VERSION = 3
+HEADER = struct.Struct("!BI")
+SEQ = struct.Struct("!Q")
+KIND_JSON = 0
+KIND_CHAT = 1
+KIND_TOKEN = 2
+CHAT_KEYS = {"username", "payload"}
+CHAT_KEYS_SEQ = {"username", "payload", "seq"}
+
+
+def encode_packet(kind: int, body: bytes) -> bytes:
+    return HEADER.pack(kind, len(body)) + body
+
+
+def chat_packet(username: str, payload: bytes, kind: int = KIND_CHAT, seq: int = 0) -> bytes:
+    name = username.encode()
+    if len(name) > 255:
+        raise ValueError("Username too long for a chat packet")
+    return encode_packet(kind, SEQ.pack(seq) + bytes((len(name),)) + name + payload)
+
+
+def decode_chat(body: bytes) -> tuple[int, str, bytes]:
+    if len(body) < SEQ.size + 1 or len(body) < SEQ.size + body[SEQ.size] + 1:
+        raise ValueError("Truncated chat packet")
+    seq = SEQ.unpack_from(body)[0]
+    end = SEQ.size + body[SEQ.size] + 1
+    return seq, body[SEQ.size + 1:end].decode(), body[end:]
+
+
+def message_from_packet(kind: int, body: bytes) -> dict:
+    if kind == KIND_JSON:
+        return json.loads(body)
+    if kind == KIND_CHAT or kind == KIND_TOKEN:
+        seq, username, payload = decode_chat(body)
+        if kind == KIND_TOKEN:
+            message = {"username": username, "payload": base64.urlsafe_b64encode(payload).decode()}
+        else:
+            message = {"username": username, "payload": payload.decode()}
+        if seq:
+            message["seq"] = seq
+        return message
+    raise ValueError(f"Unknown packet kind {kind}")
+
+
+def packet_from_message(message: dict) -> bytes:
+    if (isinstance(message, dict) and message.keys() in (CHAT_KEYS, CHAT_KEYS_SEQ)
+            and isinstance(message["username"], str) and isinstance(message["payload"], str)
+            and isinstance(message.get("seq", 0), int)):
+        try:
+            return chat_packet(message["username"], message["payload"].encode(), seq=message.get("seq", 0))
+        except (ValueError, struct.error):
+            pass
+    return encode_packet(KIND_JSON, json.dumps(message).encode())
+
+
+def encode_message(message: dict, binary: bool = False) -> bytes:
+    if binary:
+        return packet_from_message(message)
+    return (json.dumps(message) + "\n").encode()
+
+
+# A frame is built once per logical message and the same immutable bytes
+# are handed to every recipient's transport. Each encoding is produced at
+# most once, and only if some recipient needs it.
+
+class Frame:
+    __slots__ = ("_line", "_packet", "_message", "kind")
+
+    def __init__(self, line: bytes = None, kind: str = None, packet: bytes = None, message: dict = None):
+        self._line = line
+        self._packet = packet
+        self._message = message
+        self.kind = kind
+
+    @classmethod
+    def encode(cls, message: dict, kind: str = None) -> "Frame":
+        return cls(kind=kind, message=message)
+
+    @classmethod
+    def from_line(cls, line: bytes) -> "Frame":
+        # Relay the client's own validated bytes instead of re-serializing
+        message = json.loads(line)
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        return cls(line, message=message)
+
+    @classmethod
+    def from_packet(cls, kind: int, packet: bytes, body: bytes) -> "Frame":
+        return cls(packet=packet, message=message_from_packet(kind, body))
+
+    def with_seq(self, seq: int) -> "Frame":
+        # Stamp a store sequence number without re-serializing: the JSON
+        # line gets the key spliced in front, chat packets get the seq
+        # field overwritten
+        message = self.message
+        frame = Frame(kind=self.kind, message={**message, "seq": seq})
+        if "seq" in message:
+            return frame
+        if self._line is not None and self._line.startswith(b"{") and message:
+            frame._line = b'{"seq": %d, ' % seq + self._line[1:]
+        if self._packet is not None and self._packet[0] in (KIND_CHAT, KIND_TOKEN):
+            frame._packet = self._packet[:HEADER.size] + SEQ.pack(seq) + self._packet[HEADER.size + SEQ.size:]
+        return frame
+
+    @property
+    def message(self) -> dict:
+        if self._message is None:
+            self._message = json.loads(self._line)
+        return self._message
+
+    @property
+    def line(self) -> bytes:
+        if self._line is None:
+            self._line = (json.dumps(self.message) + "\n").encode()
+        return self._line
+
+    @property
+    def packet(self) -> bytes:
+        if self._packet is None:
+            self._packet = packet_from_message(self.message)
+        return self._packet
+
+
+def system_frame(text: str, **extra) -> Frame:
+    return Frame.encode({"system": True, "text": text, **extra})
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+async def skip_line(reader: asyncio.StreamReader, consumed: int):
+    # Throw away the rest of an over-long line a buffer at a time
+    while True:
+        await reader.readexactly(consumed)
+        try:
+            await reader.readuntil(b"\n")
+            return
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+
+
+async def skip_bytes(reader: asyncio.StreamReader, count: int):
+    while count:
+        data = await reader.read(min(count, 2 ** 16))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", count)
+        count -= len(data)
+
+
+async def read_frame(reader: asyncio.StreamReader, binary: bool = False, limit: int = 2 ** 16):
+    # Returns None on EOF, raises ValueError for a frame that does not parse.
+    # A frame over `limit` bytes (or a line over the reader's own limit) is
+    # skipped as it arrives, never buffered whole, and raises FrameTooLarge
+    # with the stream positioned at the next frame
+    try:
+        if not binary:
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                if not e.partial:
+                    return None
+                line = e.partial
+            except asyncio.LimitOverrunError as e:
+                await skip_line(reader, e.consumed)
+                raise FrameTooLarge(f"Line is over the {limit} byte limit")
+            if len(line) > limit + 1:
+                raise FrameTooLarge(f"Line of {len(line)} bytes is over the {limit} byte limit")
+            return Frame.from_line(line)
+        header = await reader.readexactly(HEADER.size)
+        kind, length = HEADER.unpack(header)
+        if length > limit:
+            await skip_bytes(reader, length)
+            raise FrameTooLarge(f"Packet of {length} bytes is over the {limit} byte limit")
+        body = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+    return Frame.from_packet(kind, header + body, body)
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+
+# GCRA rate limiting: each key only stores its theoretical arrival time,
+# so the state is one float no matter how many messages were sent
+
+class _State:
+    __slots__ = ("tat",)
+
+    def __init__(self, tat: float):
+        self.tat = tat
+
+
+class RateLimiter:
+    def __init__(self, limit: int, window: float, clock=time.monotonic):
+        # A limit of 0 means no limit
+        if limit < 0 or window <= 0:
+            raise ValueError(f"Rate limit must be 0 or more messages per a positive window, not {limit} per {window}")
+        self.limit = limit
+        self.window = window
+        self.interval = window / limit if limit else 0.0
+        self.tolerance = window - self.interval
+        self.clock = clock
+        self.states = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def reserve(self, key) -> float:
+        # Shaping instead of policing: the message is always accepted and
+        # the result is how long the caller should wait before acting on
+        # it, 0 while the key is within its limit of `limit` per `window`
+        if not self.limit:
+            return 0.0
+        now = self.clock()
+        state = self.states.get(key)
+        if state is None:
+            self.states[key] = _State(now + self.interval)
+            return 0.0
+        tat = state.tat if state.tat > now else now
+        state.tat = tat + self.interval
+        return max(0.0, tat - now - self.tolerance)
+
+    def evict_idle(self) -> int:
+        # A key whose TAT is in the past has a full allowance again,
+        # dropping it is indistinguishable from keeping it
+        now = self.clock()
+        idle = [key for key, state in self.states.items() if state.tat <= now]
+        for key in idle:
+            del self.states[key]
+        return len(idle)
+
+    async def run_evictor(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.evict_idle()
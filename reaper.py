@@ -0,0 +1,83 @@
+import asyncio
+import math
+import time
+
+
+# Idle connection reaping with a hashed timer wheel. Reads only store a
+# timestamp, nothing is scheduled per read. Every tick the reaper looks at
+# one slot: connections that have been idle past their timeout are expired,
+# the others are moved to the slot of their new deadline. Deadlines further
+# out than one turn of the wheel are simply checked again a turn later
+
+class _Entry:
+    __slots__ = ("last_active", "timeout", "on_expire", "slot")
+
+    def __init__(self, last_active: float, timeout: float, on_expire):
+        self.last_active = last_active
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self.slot = None
+
+
+class Reaper:
+    def __init__(self, tick: float = 1.0, slots: int = 512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, conn, timeout: float, on_expire):
+        entry = self.entries[conn] = _Entry(self.clock(), timeout, on_expire)
+        self._schedule(conn, entry, entry.last_active)
+
+    def touch(self, conn):
+        entry = self.entries.get(conn)
+        if entry is not None:
+            entry.last_active = self.clock()
+
+    def set_timeout(self, conn, timeout: float):
+        # A shorter timeout can only take effect once the current slot comes up
+        entry = self.entries.get(conn)
+        if entry is not None:
+            entry.timeout = timeout
+            entry.last_active = self.clock()
+
+    def remove(self, conn):
+        entry = self.entries.pop(conn, None)
+        if entry is not None:
+            self.slots[entry.slot].discard(conn)
+
+    def advance(self) -> int:
+        self.position = (self.position + 1) % len(self.slots)
+        due = self.slots[self.position]
+        if not due:
+            return 0
+        self.slots[self.position] = set()
+        now = self.clock()
+        expired = 0
+        for conn in due:
+            entry = self.entries.get(conn)
+            if entry is None:
+                continue
+            if entry.last_active + entry.timeout <= now:
+                del self.entries[conn]
+                expired += 1
+                entry.on_expire()
+            else:
+                self._schedule(conn, entry, now)
+        return expired
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+    def _schedule(self, conn, entry: _Entry, now: float):
+        ticks = math.ceil((entry.last_active + entry.timeout - now) / self.tick)
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        entry.slot = (self.position + ticks) % len(self.slots)
+        self.slots[entry.slot].add(conn)
@@ -0,0 +1,64 @@
+# Connected users for one group (encrypted or unencrypted). Lookups by
+# connection and by case-folded name are both constant time, and the user
+# list sent to clients is cached until the next join or leave. In --workers
+# mode users connected to other workers are tracked by name only
+
+class UserRegistry:
+    def __init__(self):
+        self.users = {}
+        self.names = {}
+        self.remote = {}
+        self.version = 0
+        self._user_list = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __contains__(self, conn):
+        return conn in self.users
+
+    def get(self, conn):
+        return self.users.get(conn)
+
+    def is_taken(self, username: str) -> bool:
+        key = username.casefold()
+        return key in self.names or key in self.remote
+
+    def find(self, username: str):
+        return self.names.get(username.casefold())
+
+    def add(self, conn, username: str) -> bool:
+        if self.is_taken(username):
+            return False
+        self.names[username.casefold()] = conn
+        self.users[conn] = username
+        self._changed()
+        return True
+
+    def remove(self, conn):
+        username = self.users.pop(conn, None)
+        if username is None:
+            return None
+        self.names.pop(username.casefold(), None)
+        self._changed()
+        return username
+
+    def add_remote(self, username: str):
+        self.remote[username.casefold()] = username
+        self._changed()
+
+    def remove_remote(self, username: str):
+        if self.remote.pop(username.casefold(), None) is not None:
+            self._changed()
+
+    def user_list(self) -> list:
+        if self._user_list is None:
+            self._user_list = list(self.users.values()) + list(self.remote.values())
+        return self._user_list
+
+    def _changed(self):
+        self.version += 1
+        self._user_list = None
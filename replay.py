@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import platform
+import pstats
+import statistics
+import sys
+import signal
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from dotenv import load_dotenv
+from tracefile import CLOSE, OPEN, read_trace
+
+
+# Replays a trace recorded with TRACE_FILE against server.py in this
+# process. Every recorded connection gets a fake transport that feeds its
+# frames to handle_client and counts what the server writes back, so the
+# same workload can be run again and again without sockets, clients or
+# network noise. By default the trace is replayed at full speed, --speed 1
+# keeps the recorded timing (2 is twice as fast).
+#
+#   python replay.py trace.bin.gz --repeat 5 --profile replay.prof --sample replay.folded
+#
+# --profile writes cProfile stats and prints the time spent in the hot
+# paths below, --sample writes sampled stacks in the collapsed format of
+# flamegraph.pl, speedscope and inferno. py-spy works as well:
+#
+#   py-spy record -o replay.svg -- python replay.py trace.bin.gz
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Reported on their own with --profile, as (label, file, function)
+HOT_PATHS = (
+    ("broadcast", "server.py", "broadcast"),
+    ("json.loads", os.path.join("json", "__init__.py"), "loads"),
+    ("validate_username", "server.py", "validate_username"),
+    ("rate_limit_delay", "server.py", "rate_limit_delay"),
+)
+# At full speed the rate limiter would only add sleeps
+FULL_SPEED_SETTINGS = {
+    "RATE_LIMIT": "1000000000",
+    "RATE_WINDOW": "1",
+}
+
+
+def load_server(settings: dict, env_file: str):
+    # Settings come from `settings`, then env_file (the server's .env), then
+    # the server's defaults. server.py may write a default .env when it is
+    # imported, so it is imported in a scratch directory
+    os.environ.update(settings)
+    if env_file and os.path.exists(env_file):
+        load_dotenv(env_file)
+    os.environ.pop("TRACE_FILE", None)
+    sys.path.insert(0, HERE)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="enigma-replay-") as scratch:
+        os.chdir(scratch)
+        try:
+            import server
+        finally:
+            os.chdir(cwd)
+    return server
+
+
+# A client socket as the server sees it: reads come from the trace, writes
+# are counted and thrown away and the socket never pushes back
+
+class ReplayTransport(asyncio.Transport):
+    def __init__(self, protocol: asyncio.Protocol, peername: tuple):
+        super().__init__({"peername": peername, "socket": None})
+        self.protocol = protocol
+        self.closing = False
+        self.bytes_out = 0
+        self.writes = 0
+
+    def write(self, data: bytes):
+        self.bytes_out += len(data)
+        self.writes += 1
+
+    def writelines(self, lines):
+        for data in lines:
+            self.bytes_out += len(data)
+        self.writes += 1
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            asyncio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class ReplayConnection:
+    def __init__(self, server, connection: int, limit: int):
+        # Wired up the way asyncio.start_server does it
+        self.reader = asyncio.StreamReader(limit)
+        self.protocol = asyncio.StreamReaderProtocol(self.reader)
+        self.transport = ReplayTransport(self.protocol, (f"replay-{connection}", 0))
+        self.protocol.connection_made(self.transport)
+        writer = asyncio.StreamWriter(self.transport, self.protocol, self.reader, asyncio.get_running_loop())
+        self.task = asyncio.create_task(server.handle_client(self.reader, writer))
+        self.eof = False
+
+    def feed(self, data: bytes):
+        if not self.transport.closing and not self.eof:
+            self.protocol.data_received(data)
+
+    def close(self):
+        if not self.transport.closing and not self.eof:
+            self.eof = True
+            self.protocol.eof_received()
+
+
+# Statistical profiler: SIGPROF fires after every `interval` seconds of
+# CPU time and the handler counts the stack it interrupted. The handler
+# runs on the main thread between bytecodes, so unlike sampling from
+# another thread it does not only catch the event loop waiting in select
+
+class Sampler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+async def replay_once(server, records: list, speed: float, timeout: float) -> dict:
+    limit = max(server.STREAM_LIMIT, server.MAX_FRAME_BYTES)
+    connections = {}
+    frames = 0
+    bytes_in = 0
+    started = time.perf_counter()
+    for timestamp, connection, kind, data in records:
+        if speed:
+            delay = timestamp / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == OPEN:
+            connections[connection] = ReplayConnection(server, connection, limit)
+        elif connection in connections:
+            if kind == CLOSE:
+                connections[connection].close()
+            else:
+                connections[connection].feed(data)
+                frames += 1
+                bytes_in += len(data)
+        # One loop iteration per record, so the server keeps up with the
+        # feed the same way on every run
+        await asyncio.sleep(0)
+    for conn in connections.values():
+        conn.close()
+    tasks = [conn.task for conn in connections.values()]
+    _, pending = await asyncio.wait(tasks, timeout=timeout) if tasks else (set(), set())
+    elapsed = time.perf_counter() - started
+    for task in pending:
+        task.cancel()
+    transports = [conn.transport for conn in connections.values()]
+    return {
+        "connections": len(connections),
+        "frames": frames,
+        "bytes_in": bytes_in,
+        "bytes_out": sum(transport.bytes_out for transport in transports),
+        "writes": sum(transport.writes for transport in transports),
+        "elapsed_s": elapsed,
+        "frames_per_sec": frames / elapsed if elapsed else 0,
+        "timed_out": bool(pending),
+    }
+
+
+async def replay_all(server, records: list, args, profiler: cProfile.Profile = None, sampler: Sampler = None) -> list:
+    # The server's background tasks are started once, their state is tied
+    # to this event loop
+    tasks = [asyncio.create_task(server.ingress.run()), asyncio.create_task(server.reaper.run())]
+    results = []
+    try:
+        for run in range(args.repeat):
+            if profiler is not None:
+                profiler.enable()
+            if sampler is not None:
+                sampler.start()
+            result = await replay_once(server, records, args.speed, args.timeout)
+            if sampler is not None:
+                sampler.stop()
+            if profiler is not None:
+                profiler.disable()
+            print_result(run, result)
+            results.append(result)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results
+
+
+def print_result(run: int, result: dict):
+    print(
+        f"run {run}: {result['frames']} frames from {result['connections']} connections in "
+        f"{result['elapsed_s'] * 1000:.1f} ms ({result['frames_per_sec']:.0f} frames/s), "
+        f"{result['bytes_in'] / 1e6:.2f} MB in, {result['bytes_out'] / 1e6:.2f} MB out in {result['writes']} writes"
+        + (" TIMEOUT" if result["timed_out"] else "")
+    )
+
+
+def hot_paths(profiler: cProfile.Profile) -> list:
+    stats = pstats.Stats(profiler).stats
+    rows = []
+    for label, path, name in HOT_PATHS:
+        calls = own = total = 0
+        for (filename, _, function), (_, ncalls, tottime, cumtime, _) in stats.items():
+            if function == name and filename.endswith(path):
+                calls += ncalls
+                own += tottime
+                total += cumtime
+        rows.append({"function": label, "calls": calls, "own_s": own, "total_s": total})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded trace against the Enigma server in process")
+    parser.add_argument("trace", help="file recorded with TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=0, help="0 for full speed, 1 for the recorded timing, 2 for twice as fast")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the trace this many times")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the server to finish after the trace ends")
+    parser.add_argument("--env-file", default=".env", help="server settings to replay with, like the server's own .env")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="extra server setting")
+    parser.add_argument("--profile", metavar="FILE", help="write cProfile stats to this file")
+    parser.add_argument("--top", type=int, default=0, metavar="N", help="with --profile, also list the N slowest functions")
+    parser.add_argument("--sample", metavar="FILE", help="write sampled stacks in collapsed format to this file")
+    parser.add_argument("--sample-interval", type=float, default=1, help="sampling interval in ms of CPU time")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    records = list(read_trace(args.trace))
+    settings = {} if args.speed else dict(FULL_SPEED_SETTINGS)
+    settings.update(item.split("=", 1) for item in args.server_env)
+    server = load_server(settings, args.env_file)
+
+    profiler = cProfile.Profile() if args.profile else None
+    sampler = Sampler(args.sample_interval / 1000) if args.sample else None
+    results = asyncio.run(replay_all(server, records, args, profiler, sampler))
+
+    elapsed = [result["elapsed_s"] for result in results]
+    if len(results) > 1:
+        print(f"median {statistics.median(elapsed) * 1000:.1f} ms, min {min(elapsed) * 1000:.1f} ms")
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "trace": args.trace,
+        "speed": args.speed,
+        "settings": settings,
+        "results": results,
+        "median_elapsed_s": statistics.median(elapsed),
+    }
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+        report["hot_paths"] = hot_paths(profiler)
+        print(f"\n{'function':<28}{'calls':>10}{'own ms':>12}{'total ms':>12}")
+        for row in report["hot_paths"]:
+            print(f"{row['function']:<28}{row['calls']:>10}{row['own_s'] * 1000:>12.1f}{row['total_s'] * 1000:>12.1f}")
+        if args.top:
+            print()
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.top)
+    if sampler is not None:
+        sampler.write(args.sample)
+        print(f"{sum(sampler.stacks.values())} samples written to {args.sample}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import heapq
+from presence import Presence
+from registry import UserRegistry
+
+
+# Rooms for one group (encrypted or unencrypted). Each room keeps its own
+# member registry and presence, and every connection keeps the set of rooms
+# it is in, so a message only touches the subscribers of its room and a
+# disconnect only touches the rooms that connection had joined. Rooms are
+# created on first join and dropped when the last member leaves
+
+class Room:
+    __slots__ = ("name", "members", "presence")
+
+    def __init__(self, name: str, window: float):
+        self.name = name
+        self.members = UserRegistry()
+        self.presence = Presence(self.members, window, room=name)
+
+    def __len__(self):
+        return len(self.members) + len(self.members.remote)
+
+
+class Rooms:
+    def __init__(self, window: float = 0.25):
+        self.window = window
+        self.rooms = {}
+        self.joined = {}
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, name: str):
+        return self.rooms.get(name)
+
+    def rooms_of(self, conn) -> set:
+        return self.joined.get(conn, frozenset())
+
+    def join(self, conn, username: str, name: str) -> bool:
+        joined = self.joined.setdefault(conn, set())
+        if name in joined:
+            return False
+        room = self._room(name)
+        room.members.add(conn, username)
+        joined.add(name)
+        room.presence.join(conn, username)
+        return True
+
+    def leave(self, conn, name: str) -> bool:
+        joined = self.joined.get(conn)
+        if not joined or name not in joined:
+            return False
+        joined.discard(name)
+        if not joined:
+            del self.joined[conn]
+        room = self.rooms[name]
+        room.presence.leave(room.members.remove(conn))
+        self._prune(room)
+        return True
+
+    def leave_all(self, conn) -> list:
+        names = list(self.joined.get(conn, ()))
+        for name in names:
+            self.leave(conn, name)
+        return names
+
+    def add_remote(self, name: str, username: str):
+        room = self._room(name)
+        room.members.add_remote(username)
+        room.presence.join(None, username)
+
+    def remove_remote(self, name: str, username: str):
+        room = self.rooms.get(name)
+        if room is None or not room.members.is_taken(username):
+            return
+        room.members.remove_remote(username)
+        room.presence.leave(username)
+        self._prune(room)
+
+    def busiest(self, limit: int) -> list:
+        return [(room.name, len(room)) for room in heapq.nlargest(limit, self.rooms.values(), key=len)]
+
+    def _room(self, name: str) -> Room:
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name, self.window)
+        return room
+
+    def _prune(self, room: Room):
+        if not len(room):
+            del self.rooms[room.name]
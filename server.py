@@ -1,18 +1,72 @@
+import argparse
 import asyncio
-import json
+import contextlib
 import os
 import re
 import logging
-from collections import defaultdict
-from datetime import datetime
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
 from dotenv import load_dotenv
+from protocol import PROTOCOL_VERSION, Frame, FrameTooLarge, read_frame, system_frame
+from registry import UserRegistry
+from rooms import Rooms
+from ratelimit import RateLimiter
+from ingress import Ingress
+from reaper import Reaper
+from admission import Admission
+from bus import BusClient, Hub, bind_unix
+from tuning import install_event_loop, tune_socket
+from store import MessageStore
+from logqueue import start_logging
+from tracefile import LINE, PACKET, CLOSE, TraceWriter
+from metrics import Counter, Gauge, Histogram, dump_snapshots, monitor_loop_lag, serve_metrics
 
 
 DEFAULTS = {
     "SERVER_HOST": "0.0.0.0",
     "SERVER_PORT": "8000",
+    "SERVER_WORKERS": "1",
     "MAX_USERNAME_LENGTH": "20",
-    "RATE_LIMIT": "15"
+    "RATE_LIMIT": "15",
+    "RATE_WINDOW": "15",
+    "SEND_QUEUE_SIZE": "1000",
+    "SLOW_CLIENT_POLICY": "drop_oldest",
+    "PRESENCE_WINDOW": "0.25",
+    "WRITE_COALESCE_MS": "0",
+    "DRAIN_TIMEOUT": "10",
+    "RESTART_RECONNECT_DELAY": "2",
+    "USE_UVLOOP": "0",
+    "STREAM_LIMIT": "65536",
+    "MAX_FRAME_BYTES": "65536",
+    "MAX_TRANSFER_BYTES": "104857600",
+    "CHUNK_BUFFER_BYTES": "1048576",
+    "SOCKET_SNDBUF": "0",
+    "SOCKET_RCVBUF": "0",
+    "TCP_KEEPALIVE": "1",
+    "TCP_KEEPIDLE": "60",
+    "METRICS_HOST": "127.0.0.1",
+    "METRICS_PORT": "0",
+    "METRICS_SNAPSHOT_INTERVAL": "0",
+    "MESSAGE_STORE_DIR": "",
+    "REPLAY_LIMIT": "1000",
+    "DEFAULT_ROOM": "lobby",
+    "MAX_ROOMS_PER_USER": "50",
+    "LOG_FILE": "server.log",
+    "LOG_LEVEL": "INFO",
+    "LOG_MAX_BYTES": "10485760",
+    "LOG_JSON": "0",
+    "LOG_SAMPLE_RATE": "1",
+    "HANDSHAKE_TIMEOUT": "15",
+    "IDLE_TIMEOUT": "300",
+    "MAX_CONNECTIONS": "10000",
+    "MAX_CONNECTIONS_PER_IP": "50",
+    "MAX_PENDING_HANDSHAKES": "256",
+    "ACCEPT_BACKLOG": "1024"
 }
 
 # Create .env file if it doesnt exist
@@ -30,25 +84,402 @@ load_dotenv()
 
 HOST = os.getenv("SERVER_HOST") or "localhost"
 PORT = int(os.getenv("SERVER_PORT") or 8000)
+WORKERS = int(os.getenv("SERVER_WORKERS") or 1)
 MAX_USERNAME_LENGTH = int(os.getenv("MAX_USERNAME_LENGTH") or 20)
 RATE_LIMIT = int(os.getenv("RATE_LIMIT") or 15)
+RATE_WINDOW = float(os.getenv("RATE_WINDOW") or 15)
+# RATE_LIMIT=0 turns rate limiting off
+if RATE_LIMIT < 0 or RATE_WINDOW <= 0:
+    raise ValueError("RATE_LIMIT must be 0 or more and RATE_WINDOW more than 0")
+RATE_EVICT_INTERVAL = float(os.getenv("RATE_EVICT_INTERVAL") or 60)
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE") or 1000)
+SLOW_CLIENT_POLICY = (os.getenv("SLOW_CLIENT_POLICY") or "drop_oldest").lower()
+SLOW_CLIENT_POLICIES = ("drop_oldest", "disconnect", "coalesce")
+if SLOW_CLIENT_POLICY not in SLOW_CLIENT_POLICIES:
+    raise ValueError(f"SLOW_CLIENT_POLICY must be one of {', '.join(SLOW_CLIENT_POLICIES)}")
+PRESENCE_WINDOW = float(os.getenv("PRESENCE_WINDOW") or 0.25)
+WRITE_COALESCE_MS = float(os.getenv("WRITE_COALESCE_MS") or 0)
+WRITE_COALESCE_BYTES = int(os.getenv("WRITE_COALESCE_BYTES") or 64 * 1024)
+USE_UVLOOP = (os.getenv("USE_UVLOOP") or "0").lower() in ("1", "true", "yes")
+STREAM_LIMIT = int(os.getenv("STREAM_LIMIT") or 65536)
+MAX_FRAME_BYTES = int(os.getenv("MAX_FRAME_BYTES") or 65536)
+MAX_TRANSFER_BYTES = int(os.getenv("MAX_TRANSFER_BYTES") or 100 * 1024 * 1024)
+MAX_TRANSFERS_PER_CLIENT = int(os.getenv("MAX_TRANSFERS_PER_CLIENT") or 4)
+MAX_TRANSFER_ID_LENGTH = 64
+CHUNK_BUFFER_BYTES = int(os.getenv("CHUNK_BUFFER_BYTES") or 1024 * 1024)
+CHUNK_STALL_TIMEOUT = float(os.getenv("CHUNK_STALL_TIMEOUT") or 10)
+INGRESS_QUEUE_SIZE = int(os.getenv("INGRESS_QUEUE_SIZE") or 64)
+INGRESS_QUANTUM = int(os.getenv("INGRESS_QUANTUM") or 4096)
+SOCKET_SNDBUF = int(os.getenv("SOCKET_SNDBUF") or 0)
+SOCKET_RCVBUF = int(os.getenv("SOCKET_RCVBUF") or 0)
+TCP_KEEPALIVE = (os.getenv("TCP_KEEPALIVE") or "1").lower() in ("1", "true", "yes")
+TCP_KEEPIDLE = int(os.getenv("TCP_KEEPIDLE") or 60)
+TCP_KEEPINTVL = int(os.getenv("TCP_KEEPINTVL") or 0)
+TCP_KEEPCNT = int(os.getenv("TCP_KEEPCNT") or 0)
+METRICS_HOST = os.getenv("METRICS_HOST") or "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL") or 0)
+METRICS_SNAPSHOT_FILE = os.getenv("METRICS_SNAPSHOT_FILE") or "metrics.jsonl"
+MESSAGE_STORE_DIR = os.getenv("MESSAGE_STORE_DIR") or ""
+MESSAGE_STORE_SEGMENT_BYTES = int(os.getenv("MESSAGE_STORE_SEGMENT_BYTES") or 64 * 1024 * 1024)
+MESSAGE_STORE_SEGMENTS = int(os.getenv("MESSAGE_STORE_SEGMENTS") or 16)
+MESSAGE_STORE_FSYNC = (os.getenv("MESSAGE_STORE_FSYNC") or "1").lower() in ("1", "true", "yes")
+REPLAY_LIMIT = int(os.getenv("REPLAY_LIMIT") or 1000)
+REPLAY_BATCH = 256
+DEFAULT_ROOM = os.getenv("DEFAULT_ROOM") or "lobby"
+MAX_ROOMS_PER_USER = int(os.getenv("MAX_ROOMS_PER_USER") or 50)
+MAX_ROOM_NAME_LENGTH = int(os.getenv("MAX_ROOM_NAME_LENGTH") or 32)
+ROOM_LIST_LIMIT = int(os.getenv("ROOM_LIST_LIMIT") or 100)
+
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT") or 10)
+RESTART_RECONNECT_DELAY = float(os.getenv("RESTART_RECONNECT_DELAY") or 2)
+RESTART_READY_TIMEOUT = float(os.getenv("RESTART_READY_TIMEOUT") or 30)
+HANDSHAKE_TIMEOUT = float(os.getenv("HANDSHAKE_TIMEOUT") or 15)
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT") or 300)
+REAPER_TICK = float(os.getenv("REAPER_TICK") or 1)
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS") or 10000)
+MAX_CONNECTIONS_PER_IP = int(os.getenv("MAX_CONNECTIONS_PER_IP") or 50)
+MAX_PENDING_HANDSHAKES = int(os.getenv("MAX_PENDING_HANDSHAKES") or 256)
+ACCEPT_BACKLOG = int(os.getenv("ACCEPT_BACKLOG") or 1024)
+LOG_FILE = os.getenv("LOG_FILE") or "server.log"
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or "INFO").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES") or 10 * 1024 * 1024)
+LOG_ROTATE_INTERVAL = float(os.getenv("LOG_ROTATE_INTERVAL") or 0)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS") or 5)
+LOG_JSON = (os.getenv("LOG_JSON") or "0").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or 10000)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE") or 1)
+TRACE_FILE = os.getenv("TRACE_FILE") or ""
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES") or 1024 * 1024 * 1024)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("server.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
-encrypted_clients = {}
-unencrypted_clients = {}
-user_message_time = defaultdict(list)
+# Per-connection events, sampled by LOG_SAMPLE_RATE
+SAMPLED = {"sample": True}
+encrypted_clients = UserRegistry()
+unencrypted_clients = UserRegistry()
+encrypted_rooms = Rooms(PRESENCE_WINDOW)
+unencrypted_rooms = Rooms(PRESENCE_WINDOW)
+rate_limiter = RateLimiter(RATE_LIMIT, RATE_WINDOW)
+ingress = Ingress(INGRESS_QUEUE_SIZE, INGRESS_QUANTUM)
+reaper = Reaper(REAPER_TICK)
+admission = Admission(MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP, MAX_PENDING_HANDSHAKES)
+bus = None
+# Set on SIGTERM/SIGHUP, no new handshakes or messages are accepted
+draining = False
+# Message stores by is_encrypted, only when MESSAGE_STORE_DIR is set
+stores = {}
+# Records received traffic for replay.py, only when TRACE_FILE is set
+tracer = None
+
+
+# Metrics, served on METRICS_PORT when it is set
+
+def queue_depths():
+    return [len(conn.queue) for group in (encrypted_clients, unencrypted_clients) for conn in group]
+
+BROADCAST_SECONDS = Histogram("enigma_broadcast_seconds", "Time to fan a frame out to every recipient queue")
+DRAIN_WAIT_SECONDS = Histogram("enigma_drain_wait_seconds", "Time a client writer spent waiting in drain()")
+HANDSHAKE_SECONDS = Histogram("enigma_handshake_seconds", "Time from accept to a completed handshake")
+LOOP_LAG_SECONDS = Histogram("enigma_event_loop_lag_seconds", "How late the event loop ran a timer")
+LOOP_LAG = Gauge("enigma_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+RATE_LIMITED_TOTAL = Counter("enigma_rate_limited_total", "Messages delayed by the rate limiter")
+PARSE_ERRORS_TOTAL = Counter("enigma_parse_errors_total", "Frames that failed to parse")
+OVERSIZED_FRAMES_TOTAL = Counter("enigma_oversized_frames_total", "Frames over MAX_FRAME_BYTES, skipped unread")
+TRANSFER_SKIPS_TOTAL = Counter("enigma_transfer_skips_total", "Recipients dropped from a transfer for falling behind")
+BYTES_IN_TOTAL = Counter("enigma_bytes_in_total", "Bytes received from clients")
+BYTES_OUT_TOTAL = Counter("enigma_bytes_out_total", "Bytes written to clients")
+WRITE_BATCH_FRAMES = Histogram(
+    "enigma_write_batch_frames", "Frames sent per write when WRITE_COALESCE_MS is set",
+    (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+DROPPED_FRAMES_TOTAL = Counter("enigma_dropped_frames_total", "Frames dropped or coalesced for slow clients")
+REJECTED_TOTAL = Counter("enigma_connections_rejected_total", "Connections refused by admission control")
+IDLE_TIMEOUTS_TOTAL = Counter("enigma_idle_timeouts_total", "Connections closed by the idle reaper")
+LOG_DROPPED_TOTAL = Counter("enigma_log_dropped_total", "Log records dropped because the log queue was full")
+Gauge("enigma_clients", "Connected clients", lambda: len(encrypted_clients) + len(unencrypted_clients))
+Gauge("enigma_connections", "Open connections, including ones still in the handshake", lambda: admission.connections)
+Gauge("enigma_handshakes_in_progress", "Handshakes being processed", lambda: admission.handshaking)
+Gauge("enigma_handshakes_waiting", "Connections waiting for a handshake slot", lambda: admission.waiting)
+Gauge("enigma_rooms", "Rooms with at least one member", lambda: len(encrypted_rooms) + len(unencrypted_rooms))
+Gauge("enigma_send_queue_frames", "Frames waiting in all client send queues", lambda: sum(queue_depths()))
+Gauge("enigma_send_queue_max_frames", "Deepest client send queue", lambda: max(queue_depths(), default=0))
+Gauge("enigma_ingress_queue_frames", "Received frames waiting to be handled", lambda: len(ingress))
+Gauge("enigma_chunk_buffer_bytes", "Transfer chunks waiting in all client send queues", lambda: sum(
+    conn.chunk_bytes for group in (encrypted_clients, unencrypted_clients) for conn in group
+))
+
+USERNAME_TAKEN = system_frame("Username already in use")
+RESTARTING = system_frame(
+    f"Server restarting, reconnect within {RESTART_RECONNECT_DELAY:g}s",
+    restart=True, reconnect_in=RESTART_RECONNECT_DELAY,
+)
+RATE_LIMITED = system_frame(f"Rate limit exceeded: Max {RATE_LIMIT} messages per {RATE_WINDOW:g} seconds, your messages are delayed")
+NOT_DELIVERED = system_frame("Server restarting, messages sent from now on are not delivered, send them again after reconnecting")
+FRAME_TOO_LARGE = system_frame(f"Message too large: Max {MAX_FRAME_BYTES} bytes, send large messages in chunks")
+
+
+# Every connection gets its own outbound queue and writer task so one slow
+# reader never holds up delivery to the rest of the group. With a coalesce
+# window the writer lets frames pile up for that long (or until
+# coalesce_bytes are waiting) and sends them with one writelines call,
+# trading a little latency for far fewer syscalls. Chunks of large
+# transfers wait in their own queue: they are never dropped, they go out
+# after any waiting chat, and the sender is paused instead while more than
+# chunk_buffer bytes of them are waiting
+
+class ClientConnection:
+    def __init__(self, writer: asyncio.StreamWriter, queue_size: int = SEND_QUEUE_SIZE, policy: str = SLOW_CLIENT_POLICY,
+                 coalesce_window: float = WRITE_COALESCE_MS / 1000, coalesce_bytes: int = WRITE_COALESCE_BYTES,
+                 chunk_buffer: int = CHUNK_BUFFER_BYTES):
+        self.writer = writer
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.policy = policy
+        self.coalesce_window = coalesce_window
+        self.coalesce_bytes = coalesce_bytes
+        self.batch_bytes = 0
+        self.batch_full = asyncio.Event()
+        self.chunks = deque()
+        self.chunk_buffer = chunk_buffer
+        self.chunk_bytes = 0
+        self.chunks_drained = asyncio.Event()
+        self.chunks_drained.set()
+        # Transfers (sender, id) this client was dropped from
+        self.skipped = set()
+        self.binary = False
+        self.replaying = False
+        self.replay_task = None
+        self.held = deque()
+        self.dropped = 0
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.task = asyncio.create_task(self.write_loop())
+
+    def send(self, frame: Frame) -> bool:
+        # Never blocks: the frame is queued and the writer task sends it.
+        # The encoding is picked now, the framing can change after handshake
+        if self.closed:
+            return False
+        # Live frames wait in self.held while history is being replayed
+        queue = self.held if self.replaying else self.queue
+        if len(queue) >= self.queue_size:
+            if self.policy == "disconnect":
+                logger.info("Disconnecting slow client %s", self.writer.get_extra_info("peername"))
+                self.abort()
+                return False
+            if self.policy == "coalesce" and frame.kind is not None and self.coalesce(queue, frame):
+                return True
+            queue.popleft()
+            self.dropped += 1
+            DROPPED_FRAMES_TOTAL.inc()
+        data = frame.packet if self.binary else frame.line
+        queue.append((frame.kind, data))
+        if not self.replaying:
+            if self.coalesce_window:
+                self.batch_bytes += len(data)
+                if self.batch_bytes >= self.coalesce_bytes:
+                    self.batch_full.set()
+            self.idle.clear()
+            self.wakeup.set()
+        return True
+
+    def send_chunk(self, frame: Frame, transfer: tuple) -> bool:
+        # Past twice the buffer the sender was not paused in time (chunks
+        # from other workers cannot be), so this client leaves the transfer
+        if self.closed or transfer in self.skipped:
+            return False
+        data = frame.packet if self.binary else frame.line
+        if self.chunk_bytes + len(data) > 2 * self.chunk_buffer:
+            self.skip_transfer(transfer)
+            return False
+        self.chunks.append((transfer, data))
+        self.chunk_bytes += len(data)
+        if self.chunk_bytes > self.chunk_buffer:
+            self.chunks_drained.clear()
+        if not self.replaying:
+            self.idle.clear()
+            self.wakeup.set()
+        return True
+
+    def next_chunk(self) -> bytes:
+        data = self.chunks.popleft()[1]
+        self.chunk_bytes -= len(data)
+        if self.chunk_bytes <= self.chunk_buffer // 2:
+            self.chunks_drained.set()
+        return data
+
+    def skip_transfer(self, transfer: tuple):
+        # Drop what is queued of the transfer and tell the client it ended
+        TRANSFER_SKIPS_TOTAL.inc()
+        self.skipped.add(transfer)
+        self.chunks = deque(chunk for chunk in self.chunks if chunk[0] != transfer)
+        self.chunk_bytes = sum(len(data) for _, data in self.chunks)
+        if self.chunk_bytes <= self.chunk_buffer // 2:
+            self.chunks_drained.set()
+        sender, transfer_id = transfer
+        self.send(Frame.encode({"type": "chunk", "username": sender, "id": transfer_id, "aborted": True,
+                                "text": "Transfer dropped, you fell too far behind"}))
+
+    def coalesce(self, queue: deque, frame: Frame) -> bool:
+        # Replace the newest queued frame of the same kind (e.g. user lists),
+        # only its latest state matters to the client
+        for i in range(len(queue) - 1, -1, -1):
+            if queue[i][0] == frame.kind:
+                queue[i] = (frame.kind, frame.packet if self.binary else frame.line)
+                self.dropped += 1
+                DROPPED_FRAMES_TOTAL.inc()
+                return True
+        return False
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                if self.coalesce_window:
+                    await self.write_batches()
+                while self.queue or self.chunks:
+                    data = self.queue.popleft()[1] if self.queue else self.next_chunk()
+                    self.writer.write(data)
+                    BYTES_OUT_TOTAL.inc(len(data))
+                    started = time.perf_counter()
+                    await self.writer.drain()
+                    DRAIN_WAIT_SECONDS.observe(time.perf_counter() - started)
+                self.idle.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.abort()
 
+    async def write_batches(self):
+        if self.batch_bytes < self.coalesce_bytes:
+            self.batch_full.clear()
+            timer = asyncio.get_running_loop().call_later(self.coalesce_window, self.batch_full.set)
+            await self.batch_full.wait()
+            timer.cancel()
+        # Frames queued while draining go out in the next batch right away,
+        # they have already waited for the drain. Each batch carries at most
+        # one transfer chunk
+        while self.queue or self.chunks:
+            self.batch_bytes = 0
+            batch = [data for _, data in self.queue]
+            self.queue.clear()
+            if self.chunks:
+                batch.append(self.next_chunk())
+            self.writer.writelines(batch)
+            BYTES_OUT_TOTAL.inc(sum(map(len, batch)))
+            WRITE_BATCH_FRAMES.observe(len(batch))
+            started = time.perf_counter()
+            await self.writer.drain()
+            DRAIN_WAIT_SECONDS.observe(time.perf_counter() - started)
 
-def get_client_group(is_encrypted: bool) -> dict:
+    async def flush(self, timeout: float = 5):
+        # Wait until everything queued so far has been handed to the transport
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def start_replay(self, store: MessageStore, since: int, rooms=None, exclude: str = None) -> bool:
+        # The task is kept here so it is not garbage collected while it
+        # runs, and is cancelled with the connection. One at a time
+        if self.closed or (self.replay_task is not None and not self.replay_task.done()):
+            return False
+        self.replay_task = asyncio.create_task(self.replay(store, since, rooms, exclude))
+        return True
+
+    async def replay(self, store: MessageStore, since: int, rooms=None, exclude: str = None):
+        # Stream stored frames after `since`, then release the live frames
+        # that arrived meanwhile. Store reads run in an executor so live
+        # broadcast is never blocked on disk. Only messages for `rooms`
+        # (the live set of rooms this connection is in) are sent, and none
+        # from the user `exclude`: a client resuming after a reconnect never
+        # got its own messages back and must not get them now
+        if self.replaying:
+            return
+        self.replaying = True
+        count = 0
+        try:
+            upto = store.last_seq
+            # Sequence numbers before the oldest retained segment are gone
+            seq = max(since, upto - REPLAY_LIMIT, store.first_seq - 1, 0)
+            await self.flush()
+            await store.wait_committed(upto)
+            loop = asyncio.get_running_loop()
+            while seq < upto and not self.closed:
+                # Moves on by range, not by record count, so a range with
+                # missing records does not end the replay
+                last = min(upto, seq + REPLAY_BATCH)
+                records = await loop.run_in_executor(None, store.read, seq + 1, last)
+                seq = last
+                for line in records:
+                    frame = Frame(line)
+                    message = frame.message
+                    if rooms is not None and message.get("room", DEFAULT_ROOM) not in rooms:
+                        continue
+                    if exclude is not None and str(message.get("username", "")).casefold() == exclude:
+                        continue
+                    data = frame.packet if self.binary else line
+                    self.writer.write(data)
+                    BYTES_OUT_TOTAL.inc(len(data))
+                    count += 1
+                await self.writer.drain()
+            if not self.closed:
+                done = system_frame(f"Caught up on {count} messages", replay=count, seq=upto)
+                self.held.appendleft((None, done.packet if self.binary else done.line))
+        except Exception as e:
+            logger.error("Replay failed: %s", e)
+        finally:
+            self.replaying = False
+            self.queue.extend(self.held)
+            self.held.clear()
+            if self.queue or self.chunks:
+                self.idle.clear()
+                self.wakeup.set()
+
+    def abort(self):
+        self.closed = True
+        if self.replay_task is not None:
+            self.replay_task.cancel()
+        self.queue.clear()
+        self.clear_chunks()
+        self.idle.set()
+        if not self.task.done() and self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.writer.transport.abort()
+
+    def clear_chunks(self):
+        # Wakes a sender waiting for this client to catch up
+        self.chunks.clear()
+        self.chunk_bytes = 0
+        self.chunks_drained.set()
+
+    async def close(self, timeout: float = 5):
+        if self.replay_task is not None:
+            # Live frames it was holding back go to the queue when it ends
+            self.replay_task.cancel()
+            await asyncio.gather(self.replay_task, return_exceptions=True)
+        if not self.closed:
+            await self.flush(timeout)
+        self.closed = True
+        self.queue.clear()
+        self.clear_chunks()
+        self.task.cancel()
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+def get_client_group(is_encrypted: bool) -> UserRegistry:
     return encrypted_clients if is_encrypted else unencrypted_clients
+def get_rooms(is_encrypted: bool) -> Rooms:
+    return encrypted_rooms if is_encrypted else unencrypted_rooms
+def get_store(is_encrypted: bool) -> MessageStore:
+    return stores.get(is_encrypted)
 def validate_username(username: str) -> tuple[bool, str]:
     if not username or not username.strip():
         return False, "Username cannot be empty"
@@ -58,127 +489,637 @@ def validate_username(username: str) -> tuple[bool, str]:
     if not re.match(r'^[a-zA-Z0-9_\- ]+$', username):
         return False, "Username can only contain alphanumeric characters, underscores, hyphens, and spaces"
     return True, ""
-def enforce_rate_limit(username: str) -> bool:
-    now = datetime.now().timestamp()
-    timestamps = user_message_time[username]
-    user_message_time[username] = [t for t in timestamps if now - t < RATE_LIMIT]
-    if len(user_message_time[username]) >= RATE_LIMIT:
-        return True
-    user_message_time[username].append(now)
-    return False
-async def broadcast(message: dict, exclude=None, encrypted: bool = True):
-    group = get_client_group(encrypted)
-    line = (json.dumps(message) + "\n").encode()
-    for client in list(group.keys()):
-        if client != exclude:
-            try:
-                client.write(line)
-                await client.drain()
-            except Exception:
-                group.pop(client, None)
-async def broadcast_current_users_list(encrypted: bool):
-    group = get_client_group(encrypted)
-    user_list = list(group.values())
-    message = {"system": True, "text": "Current Users", "users": user_list}
-    await broadcast(message, encrypted=encrypted)
+def validate_room(room) -> tuple[bool, str]:
+    if not isinstance(room, str) or not room:
+        return False, "Room name cannot be empty"
+    if len(room) > MAX_ROOM_NAME_LENGTH:
+        return False, f"Room name too long. Max {MAX_ROOM_NAME_LENGTH} characters"
+    if not re.match(r'^[a-zA-Z0-9_\-]+$', room):
+        return False, "Room name can only contain alphanumeric characters, underscores and hyphens"
+    return True, ""
+def rate_limit_delay(username: str) -> float:
+    return rate_limiter.reserve(username)
+def broadcast(frame: Frame, exclude=None, encrypted: bool = True, room: str = DEFAULT_ROOM):
+    started = time.perf_counter()
+    target = get_rooms(encrypted).get(room)
+    if target is None:
+        return
+    # Aborted clients are removed from their rooms by their own handle_client
+    for client in target.members:
+        if client is not exclude:
+            client.send(frame)
+    BROADCAST_SECONDS.observe(time.perf_counter() - started)
+def relay(frame: Frame, sender, encrypted: bool, room: str = DEFAULT_ROOM):
+    store = get_store(encrypted)
+    if store is not None:
+        seq = store.next_seq()
+        frame = frame.with_seq(seq)
+        store.append(seq, frame.line)
+    broadcast(frame, exclude=sender, encrypted=encrypted, room=room)
+    if bus is not None:
+        bus.publish(encrypted, room, frame.line)
+def broadcast_chunk(frame: Frame, exclude=None, encrypted: bool = True, room: str = DEFAULT_ROOM) -> list:
+    # Returns the recipients that now have more than their chunk buffer waiting
+    message = frame.message
+    transfer = (message["username"], message["id"])
+    done = message.get("final") or message.get("aborted")
+    target = get_rooms(encrypted).get(room)
+    if target is None:
+        return []
+    behind = []
+    for client in target.members:
+        if client is exclude:
+            continue
+        if client.send_chunk(frame, transfer) and client.chunk_bytes > client.chunk_buffer:
+            behind.append(client)
+        if done:
+            client.skipped.discard(transfer)
+    return behind
+def relay_chunk(frame: Frame, sender, encrypted: bool, room: str) -> list:
+    # Transfers are not kept in the message store
+    if bus is not None:
+        bus.publish(encrypted, room, frame.line)
+    return broadcast_chunk(frame, exclude=sender, encrypted=encrypted, room=room)
+def abort_transfer(conn, username: str, is_encrypted: bool, transfer_id: str, room: str):
+    relay_chunk(Frame.encode({"type": "chunk", "username": username, "id": transfer_id, "room": room, "aborted": True}),
+                conn, is_encrypted, room)
+def join_room(conn, username: str, is_encrypted: bool, room: str):
+    if get_rooms(is_encrypted).join(conn, username, room) and bus is not None:
+        bus.enter(is_encrypted, room, username)
+def leave_room(conn, username: str, is_encrypted: bool, room: str):
+    if get_rooms(is_encrypted).leave(conn, room) and bus is not None:
+        bus.exit(is_encrypted, room, username)
+
+
+# Events coming from the other workers over the bus
+
+def on_bus_broadcast(encrypted: bool, room: str, data: bytes):
+    frame = Frame(data)
+    if frame.message.get("type") == "chunk":
+        broadcast_chunk(frame, encrypted=encrypted, room=room)
+    else:
+        broadcast(frame, encrypted=encrypted, room=room)
+def on_bus_join(encrypted: bool, username: str):
+    get_client_group(encrypted).add_remote(username)
+def on_bus_leave(encrypted: bool, username: str):
+    get_client_group(encrypted).remove_remote(username)
+def on_bus_enter(encrypted: bool, room: str, username: str):
+    get_rooms(encrypted).add_remote(room, username)
+def on_bus_exit(encrypted: bool, room: str, username: str):
+    get_rooms(encrypted).remove_remote(room, username)
+def handle_command(conn, username: str, is_encrypted: bool, command, message: dict):
+    rooms = get_rooms(is_encrypted)
+    room = message.get("room", DEFAULT_ROOM)
+    if command in ("resync", "join", "leave"):
+        valid, error_msg = validate_room(room)
+        if not valid:
+            conn.send(system_frame(error_msg))
+            return
+    if command == "resync":
+        target = rooms.get(room)
+        if target is not None and conn in target.members:
+            target.presence.resync(conn)
+    elif command == "history":
+        store = get_store(is_encrypted)
+        since = message.get("since")
+        if store is not None and isinstance(since, int):
+            if not conn.start_replay(store, since, rooms.rooms_of(conn)):
+                conn.send(system_frame("History is already being replayed"))
+    elif command == "join":
+        if room in rooms.rooms_of(conn):
+            conn.send(system_frame(f"Already in room {room}", room=room))
+        elif len(rooms.rooms_of(conn)) >= MAX_ROOMS_PER_USER:
+            conn.send(system_frame(f"Room limit reached: Max {MAX_ROOMS_PER_USER} rooms", room=room))
+        else:
+            join_room(conn, username, is_encrypted, room)
+            conn.send(system_frame(f"Joined {room}", room=room, joined=True))
+    elif command == "leave":
+        if room in rooms.rooms_of(conn):
+            leave_room(conn, username, is_encrypted, room)
+            conn.send(system_frame(f"Left {room}", room=room, joined=False))
+        else:
+            conn.send(system_frame(f"You are not in room {room}", room=room))
+    elif command == "rooms":
+        busiest = rooms.busiest(ROOM_LIST_LIMIT)
+        conn.send(system_frame(
+            f"{len(rooms)} rooms",
+            rooms=[{"name": name, "users": count} for name, count in busiest],
+            joined=sorted(rooms.rooms_of(conn)),
+        ))
+def handle_message(conn, username: str, is_encrypted: bool, frame: Frame):
+    # Runs from the ingress scheduler, in the order the sender sent
+    message = frame.message
+    command = message.get("type")
+    if command is not None:
+        handle_command(conn, username, is_encrypted, command, message)
+        return
+    room = message.get("room", DEFAULT_ROOM)
+    valid, error_msg = validate_room(room)
+    if not valid:
+        conn.send(system_frame(error_msg))
+        return
+    if room not in get_rooms(is_encrypted).rooms_of(conn):
+        conn.send(system_frame(f"You are not in room {room}", room=room))
+        return
+    relay(frame, conn, is_encrypted, room)
+def handle_chunk(conn, username: str, is_encrypted: bool, transfers: dict, message: dict) -> list:
+    # One chunk of a large transfer, relayed as it comes so the server never
+    # holds a whole transfer. Returns the recipients that are now more than
+    # their chunk buffer behind, see wait_for_recipients
+    transfer_id = message.get("id")
+    index = message.get("index")
+    payload = message.get("payload")
+    if (not isinstance(transfer_id, str) or not 0 < len(transfer_id) <= MAX_TRANSFER_ID_LENGTH
+            or not isinstance(index, int) or not isinstance(payload, str)):
+        conn.send(system_frame("Invalid chunk"))
+        return []
+    rooms = get_rooms(is_encrypted)
+    state = transfers.get(transfer_id)
+    if state is None:
+        room = message.get("room", DEFAULT_ROOM)
+        if index != 0:
+            conn.send(system_frame(f"Unknown transfer {transfer_id}", transfer=transfer_id))
+            return []
+        valid, error_msg = validate_room(room)
+        if not valid:
+            conn.send(system_frame(error_msg, transfer=transfer_id))
+            return []
+        if room not in rooms.rooms_of(conn):
+            conn.send(system_frame(f"You are not in room {room}", room=room))
+            return []
+        if len(transfers) >= MAX_TRANSFERS_PER_CLIENT:
+            conn.send(system_frame(f"Transfer limit reached: Max {MAX_TRANSFERS_PER_CLIENT} at a time", transfer=transfer_id))
+            return []
+        state = transfers[transfer_id] = [room, 0, 0]
+    room, expected, size = state
+    size += len(payload)
+    error = None
+    if index != expected:
+        error = f"expected chunk {expected}"
+    elif MAX_TRANSFER_BYTES and size > MAX_TRANSFER_BYTES:
+        error = f"over {MAX_TRANSFER_BYTES} bytes"
+    elif room not in rooms.rooms_of(conn):
+        error = f"you left {room}"
+    if error is not None:
+        del transfers[transfer_id]
+        abort_transfer(conn, username, is_encrypted, transfer_id, room)
+        conn.send(system_frame(f"Transfer {transfer_id} aborted: {error}", transfer=transfer_id))
+        return []
+    state[1] = index + 1
+    state[2] = size
+    chunk = {"type": "chunk", "username": username, "id": transfer_id, "index": index, "room": room, "payload": payload}
+    if index == 0:
+        if isinstance(message.get("name"), str):
+            chunk["name"] = message["name"][:255]
+        if isinstance(message.get("size"), int):
+            chunk["size"] = message["size"]
+    final = bool(message.get("final"))
+    if final:
+        chunk["final"] = True
+        del transfers[transfer_id]
+    return relay_chunk(Frame.encode(chunk), conn, is_encrypted, room)
+async def wait_for_recipients(behind: list, transfer: tuple, final: bool):
+    # The sender is not read from while a recipient has more than its chunk
+    # buffer waiting, a recipient that stays behind for CHUNK_STALL_TIMEOUT
+    # is dropped from the transfer instead
+    waiters = {asyncio.ensure_future(client.chunks_drained.wait()): client for client in behind}
+    try:
+        _, stalled = await asyncio.wait(waiters, timeout=CHUNK_STALL_TIMEOUT)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+    if not final:
+        for waiter in stalled:
+            waiters[waiter].skip_transfer(transfer)
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     address = writer.get_extra_info("peername")
+    accepted = time.perf_counter()
+    ip = address[0] if address else None
+    refused = admission.admit(ip)
+    if refused is not None:
+        # Turned away before anything is allocated for the connection
+        REJECTED_TOTAL.inc()
+        writer.write(system_frame(refused).line)
+        writer.transport.close()
+        return
+    tune_socket(writer.get_extra_info("socket"), SOCKET_SNDBUF, SOCKET_RCVBUF, TCP_KEEPALIVE, TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT)
+    conn = ClientConnection(writer)
+    trace_id = tracer.open() if tracer is not None else None
     username = None
     is_encrypted = True
-    logger.info(f"New connection from {address}")
+    handshaking = False
+    # Set while the rate limiter is delaying this client, so it is told once
+    throttled = False
+    # Set once the client was told its messages are refused while draining
+    refused = False
+    # Transfers this client is sending: id -> [room, next index, bytes so far]
+    transfers = {}
+    logger.info("New connection from %s", address, extra=SAMPLED)
+
+    def expire():
+        IDLE_TIMEOUTS_TOTAL.inc()
+        logger.info("Timeout for %s", username or address, extra=SAMPLED)
+        conn.abort()
+
+    reaper.add(conn, HANDSHAKE_TIMEOUT, expire)
     try:
+        await admission.begin_handshake()
+        handshaking = True
         while True:
-            timeout = 15 if username is None else 300
             try:
-                line = await asyncio.wait_for(reader.readline(), timeout)
-            except asyncio.TimeoutError:
-                logger.info(f"Timeout for {username or address}")
-                writer.close()
-                await writer.wait_closed()
-                return
-            if not line:
+                frame = await read_frame(reader, conn.binary, MAX_FRAME_BYTES)
+            except FrameTooLarge:
+                OVERSIZED_FRAMES_TOTAL.inc()
+                if username is None:
+                    return
+                conn.send(FRAME_TOO_LARGE)
+                continue
+            except ValueError:
+                PARSE_ERRORS_TOTAL.inc()
+                if username is None:
+                    return
+                continue
+            if frame is None:
+                await ingress.wait_empty(conn)
                 return
-            try:
-                message = json.loads(line.decode())
-            except (json.JSONDecodeError, UnicodeDecodeError):
+            reaper.touch(conn)
+            data = frame.packet if conn.binary else frame.line
+            size = len(data)
+            BYTES_IN_TOTAL.inc(size)
+            if trace_id is not None and tracer is not None:
+                tracer.record(trace_id, PACKET if conn.binary else LINE, data)
+            if draining:
+                # Frames already queued are still handled, new ones are not.
+                # The client is told once so it can send them again
                 if username is None:
-                    writer.close()
-                    await writer.wait_closed()
+                    conn.send(RESTARTING)
                     return
+                if not refused:
+                    refused = True
+                    conn.send(NOT_DELIVERED)
                 continue
+            message = frame.message
             if username is None:
-                if "username" not in message:
-                    writer.close()
-                    await writer.wait_closed()
+                if not isinstance(message, dict) or "username" not in message:
                     return
                 username = message["username"].strip()
-                is_encrypted = message.get("encrypted", True)
+                is_encrypted = bool(message.get("encrypted", True))
                 clients_group = get_client_group(is_encrypted)
+                room = message.get("room") or DEFAULT_ROOM
                 valid, error_msg = validate_username(username)
+                if valid:
+                    valid, error_msg = validate_room(room)
                 if not valid:
-                    writer.write((json.dumps({"system": True, "text": error_msg}) + "\n").encode())
-                    await writer.drain()
-                    writer.close()
-                    await writer.wait_closed()
+                    conn.send(system_frame(error_msg))
                     return
-                normalized = username.lower()
-                if any(u.lower() == normalized for u in clients_group.values()):
-                    writer.write((json.dumps({"system": True, "text": "Username already in use"}) + "\n").encode())
-                    await writer.drain()
-                    writer.close()
-                    await writer.wait_closed()
+                if not clients_group.add(conn, username):
+                    conn.send(USERNAME_TAKEN)
                     return
-                clients_group[writer] = username
-                writer.write((json.dumps({"system": True, "text": f"Connected as {username}"}) + "\n").encode())
-                await writer.drain()
-                logger.info(f"{username} joined from {address}")
-                await broadcast({"system": True, "text": f"{username} joined"}, exclude=writer, encrypted=is_encrypted)
-                await broadcast_current_users_list(encrypted=is_encrypted)
+                if bus is not None and not await bus.claim(is_encrypted, username):
+                    clients_group.remove(conn)
+                    conn.send(USERNAME_TAKEN)
+                    return
+                # Clients that speak version 2 can switch to binary packets
+                version = message.get("version", 1)
+                framing = message.get("framing") or []
+                store = get_store(is_encrypted)
+                extra = {"seq": store.last_seq} if store is not None else {}
+                if isinstance(version, int) and version >= PROTOCOL_VERSION and "binary" in framing:
+                    conn.send(system_frame(f"Connected as {username}", version=PROTOCOL_VERSION, framing="binary", **extra))
+                    conn.binary = True
+                else:
+                    conn.send(system_frame(f"Connected as {username}", **extra))
+                HANDSHAKE_SECONDS.observe(time.perf_counter() - accepted)
+                handshaking = False
+                admission.end_handshake()
+                reaper.set_timeout(conn, IDLE_TIMEOUT)
+                logger.info("%s joined from %s", username, address, extra=SAMPLED)
+                rooms = get_rooms(is_encrypted)
+                join_room(conn, username, is_encrypted, room)
+                ingress.add(conn)
+                since = message.get("since")
+                if store is not None and isinstance(since, int):
+                    conn.start_replay(store, since, rooms.rooms_of(conn), username.casefold())
+                continue
+            if not isinstance(message, dict):
                 continue
-            if enforce_rate_limit(username):
-                writer.write((json.dumps({"system": True, "text": f"Rate limit exceeded: Max {RATE_LIMIT} messages per {RATE_LIMIT} seconds"}) + "\n").encode())
-                await writer.drain()
+            command = message.get("type")
+            if command != "chunk" or message.get("index") == 0:
+                # Over the limit the message is held back rather than
+                # dropped, and the socket is not read meanwhile, so TCP slows
+                # the client down. Commands count like messages, a whole
+                # transfer counts as one
+                delay = rate_limit_delay(username)
+                if delay > 0:
+                    RATE_LIMITED_TOTAL.inc()
+                    if not throttled:
+                        throttled = True
+                        conn.send(RATE_LIMITED)
+                    await asyncio.sleep(delay)
+                else:
+                    throttled = False
+            if command == "chunk":
+                behind = await ingress.call(conn, size, handle_chunk, conn, username, is_encrypted, transfers, message)
+                if behind:
+                    await wait_for_recipients(behind, (username, message["id"]), bool(message.get("final")))
                 continue
-            clients_group = get_client_group(is_encrypted)
-            await broadcast(message, exclude=writer, encrypted=is_encrypted)
+            await ingress.submit(conn, size, handle_message, conn, username, is_encrypted, frame)
 
+    except asyncio.CancelledError:
+        # Server shutdown, clean up below without asyncio logging the cancel
+        pass
     except Exception as e:
-        logger.error(f"Error with client {username or address}: {e}")
+        logger.error("Error with client %s: %s", username or address, e)
 
     finally:
+        if trace_id is not None and tracer is not None:
+            tracer.record(trace_id, CLOSE)
+        ingress.remove(conn)
+        if handshaking:
+            admission.end_handshake()
+        admission.release(ip)
+        reaper.remove(conn)
         clients_group = get_client_group(is_encrypted)
-        if writer in clients_group:
-            left_user = clients_group.pop(writer)
-            logger.info(f"{left_user} disconnected")
-            await broadcast({"system": True, "text": f"{left_user} left"}, exclude=writer, encrypted=is_encrypted)
-            await broadcast_current_users_list(encrypted=is_encrypted)
-        try:
-            writer.close()
-            await writer.wait_closed()
-        except Exception:
-            pass
+        left_user = clients_group.remove(conn)
+        if left_user is not None:
+            logger.info("%s disconnected", left_user, extra=SAMPLED)
+            for transfer_id, (room, _, _) in transfers.items():
+                abort_transfer(conn, left_user, is_encrypted, transfer_id, room)
+            for room in get_rooms(is_encrypted).leave_all(conn):
+                if bus is not None:
+                    bus.exit(is_encrypted, room, left_user)
+            if bus is not None:
+                bus.release(is_encrypted, left_user)
+        await conn.close()
 
 
 async def server_stats_logger():
     while True:
         await asyncio.sleep(300)
-        logger.info(f"Encrypted clients: {len(encrypted_clients)}, Unencrypted clients: {len(unencrypted_clients)}")
+        logger.info(
+            "Encrypted clients: %d in %d rooms, Unencrypted clients: %d in %d rooms",
+            len(encrypted_clients), len(encrypted_rooms), len(unencrypted_clients), len(unencrypted_rooms),
+        )
+
+
+def spawn_successor(servers: list = None, ready_fd: int = None) -> int:
+    # Start a new server with the same arguments. Given the listening
+    # sockets it inherits them, so the port never closes and connections
+    # waiting in the backlog are accepted by the new process. A --workers
+    # master writes to ready_fd once all its workers are listening
+    env = dict(os.environ)
+    fds = []
+    if servers:
+        fds = [sock.fileno() for server in servers for sock in server.sockets]
+        env["LISTEN_FDS"] = ",".join(map(str, fds))
+    if ready_fd is not None:
+        env["READY_FD"] = str(ready_fd)
+        fds.append(ready_fd)
+    process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds, start_new_session=True)
+    logger.info("Started new server process %d", process.pid)
+    return process.pid
+
+
+async def listen(reuse_port: bool) -> list:
+    inherited = os.environ.pop("LISTEN_FDS", "")
+    if inherited:
+        return [
+            await asyncio.start_server(handle_client, sock=socket.socket(fileno=int(fd)), limit=max(STREAM_LIMIT, MAX_FRAME_BYTES), backlog=ACCEPT_BACKLOG)
+            for fd in inherited.split(",")
+        ]
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, limit=max(STREAM_LIMIT, MAX_FRAME_BYTES), reuse_port=reuse_port, backlog=ACCEPT_BACKLOG,
+    )
+    return [server]
+
+
+def close_servers(servers: list):
+    for server in servers:
+        server.close()
+
+
+async def drain(servers: list, tasks: list, restart: bool):
+    # Stop accepting, handle the messages already queued, tell every client
+    # to reconnect and give their queues DRAIN_TIMEOUT seconds to flush.
+    # Stores, the trace and the metrics port are released before a
+    # successor starts so it can open them. On restart the listening
+    # sockets stay open until the successor has them, so the port never
+    # refuses a connection
+    global draining, tracer
+    draining = True
+    if not restart:
+        close_servers(servers)
+    try:
+        await asyncio.wait_for(ingress.wait_idle(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Dropping %d queued messages after %gs", len(ingress), DRAIN_TIMEOUT)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    tasks.clear()
+    ingress.clear()
+    for store in stores.values():
+        store.close()
+    stores.clear()
+    if tracer is not None:
+        tracer.close()
+        tracer = None
+    if restart:
+        spawn_successor(servers)
+        close_servers(servers)
+    conns = [conn for group in (encrypted_clients, unencrypted_clients) for conn in group]
+    logger.info("Draining %d connections%s", len(conns), " for restart" if restart else "")
+    for conn in conns:
+        conn.send(RESTARTING)
+    await asyncio.gather(*(conn.close(DRAIN_TIMEOUT) for conn in conns))
 
 
-async def main():
+async def main(bus_path: str = None, worker_index: int = 0):
+    global bus, tracer
+    tasks = []
+    servers = []
+    # SIGTERM drains and exits, SIGHUP drains and hands the port to a new
+    # process. In --workers mode the master handles SIGHUP
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+
+    def on_signal(restart: bool):
+        if not stop.done():
+            stop.set_result(restart)
+
+    loop.add_signal_handler(signal.SIGTERM, on_signal, False)
+    if bus_path is None:
+        loop.add_signal_handler(signal.SIGHUP, on_signal, True)
+    if MESSAGE_STORE_DIR and bus_path is not None:
+        # Sequence numbers would have to be shared between workers
+        logger.warning("MESSAGE_STORE_DIR is ignored in --workers mode")
+    elif MESSAGE_STORE_DIR:
+        for is_encrypted, name in ((True, "encrypted"), (False, "unencrypted")):
+            stores[is_encrypted] = MessageStore(
+                os.path.join(MESSAGE_STORE_DIR, name), MESSAGE_STORE_SEGMENT_BYTES,
+                MESSAGE_STORE_SEGMENTS, MESSAGE_STORE_FSYNC,
+            )
+    if TRACE_FILE:
+        # Like the logs, worker i writes its own trace.i file
+        root, ext = os.path.splitext(TRACE_FILE)
+        path = TRACE_FILE if bus_path is None else f"{root}.{worker_index}{ext}"
+        tracer = TraceWriter(path, TRACE_MAX_BYTES)
+        logger.warning("Recording traffic to %s, it holds usernames and unencrypted messages", tracer.path)
     try:
-        server = await asyncio.start_server(handle_client, HOST, PORT)
-        address = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-        logger.info(f"Server started on {address}")
-        logging_task = asyncio.create_task(server_stats_logger())
-        async with server:
-            await server.serve_forever()
+        if bus_path is not None:
+            bus = BusClient(on_bus_broadcast, on_bus_join, on_bus_leave, on_bus_enter, on_bus_exit)
+            await bus.connect(bus_path)
+        servers = await listen(bus_path is not None)
+        address = ", ".join(str(sock.getsockname()) for server in servers for sock in server.sockets)
+        logger.info("Server started on %s (pid %d)", address, os.getpid())
+        if bus is not None:
+            bus.ready()
+        tasks.append(asyncio.create_task(server_stats_logger()))
+        tasks.append(asyncio.create_task(rate_limiter.run_evictor(RATE_EVICT_INTERVAL)))
+        tasks.append(asyncio.create_task(reaper.run()))
+        tasks.append(asyncio.create_task(ingress.run()))
+        tasks.append(asyncio.create_task(monitor_loop_lag(LOOP_LAG_SECONDS, LOOP_LAG)))
+        if METRICS_PORT:
+            # Each worker gets its own port so scrapes are not load balanced
+            tasks.append(asyncio.create_task(serve_metrics(METRICS_HOST, METRICS_PORT + worker_index)))
+        if METRICS_SNAPSHOT_INTERVAL:
+            snapshot_file = METRICS_SNAPSHOT_FILE if bus_path is None else f"{METRICS_SNAPSHOT_FILE}.{worker_index}"
+            tasks.append(asyncio.create_task(dump_snapshots(snapshot_file, METRICS_SNAPSHOT_INTERVAL)))
+        # A worker that loses the bus can no longer keep names unique
+        await asyncio.wait([stop] + ([bus.task] if bus is not None else []), return_when=asyncio.FIRST_COMPLETED)
+        if stop.done():
+            await drain(servers, tasks, stop.result())
+        else:
+            logger.error("Worker %d stopping: %s", os.getpid(), bus.task.exception())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        print("Server shutting down...")
+    finally:
+        for task in tasks:
+            task.cancel()
+        for server in servers:
+            server.close()
+        for store in stores.values():
+            store.close()
+        if tracer is not None:
+            tracer.close()
+            tracer = None
+        if bus is not None:
+            await bus.close()
+
+
+# --workers N: fork N processes that all listen on the same port with
+# SO_REUSEPORT, while this process runs the bus that connects them
+
+def run_logging(path: str):
+    return start_logging(
+        path, LOG_LEVEL, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUPS,
+        LOG_JSON, LOG_QUEUE_SIZE, LOG_SAMPLE_RATE, LOG_DROPPED_TOTAL.inc,
+    )
+
+
+def wait_for_exit(pid: int):
+    with contextlib.suppress(ChildProcessError):
+        os.waitpid(pid, 0)
+
+
+async def run_hub(hub_sock, pids: list, ready_fd: int = None):
+    # SIGTERM drains the workers, SIGHUP first starts a new master whose
+    # workers bind the same port with SO_REUSEPORT. The bus stays up until
+    # every worker has finished draining
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    stopping = []
+
+    async def stop(restart: bool):
+        if restart:
+            # Keep serving until the new workers are listening, or give up
+            # waiting after RESTART_READY_TIMEOUT
+            read_fd, write_fd = os.pipe()
+            spawn_successor(ready_fd=write_fd)
+            os.close(write_fd)
+            ready = loop.create_future()
+            loop.add_reader(read_fd, lambda: ready.done() or ready.set_result(None))
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(ready, RESTART_READY_TIMEOUT)
+            loop.remove_reader(read_fd)
+            os.close(read_fd)
+        for pid in pids:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        await asyncio.gather(*(loop.run_in_executor(None, wait_for_exit, pid) for pid in pids))
+        task.cancel()
+
+    def on_signal(restart: bool):
+        if not stopping:
+            stopping.append(asyncio.create_task(stop(restart)))
+
+    def ready():
+        # Tell the master we are replacing that our workers are listening
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+    loop.add_signal_handler(signal.SIGTERM, on_signal, False)
+    loop.add_signal_handler(signal.SIGHUP, on_signal, True)
+    try:
+        await Hub(len(pids), ready if ready_fd is not None else None).serve(hub_sock)
+    except asyncio.CancelledError:
+        pass
+
+
+def run_workers(workers: int):
+    ready_fd = os.environ.pop("READY_FD", None)
+    ready_fd = int(ready_fd) if ready_fd else None
+    bus_path = os.path.join(tempfile.mkdtemp(prefix="enigma-"), "bus.sock")
+    hub_sock = bind_unix(bus_path)
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            hub_sock.close()
+            if ready_fd is not None:
+                os.close(ready_fd)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            # Rotation is not safe across processes, so each worker has its own file
+            root, ext = os.path.splitext(LOG_FILE)
+            listener = run_logging(f"{root}.{index}{ext}")
+            try:
+                asyncio.run(main(bus_path, index))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                listener.stop()
+                os._exit(0)
+        pids.append(pid)
+    listener = run_logging(LOG_FILE)
+    logger.info("Started %d workers: %s", workers, pids)
+    try:
+        asyncio.run(run_hub(hub_sock, pids, ready_fd))
     except KeyboardInterrupt:
         print("Server shutting down...")
     finally:
-        if 'logging_task' in locals():
-            logging_task.cancel()
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        os.unlink(bus_path)
+        os.rmdir(os.path.dirname(bus_path))
+        listener.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Enigma chat relay server")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of worker processes sharing the port")
+    args = parser.parse_args()
+    install_event_loop(USE_UVLOOP)
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        listener = run_logging(LOG_FILE)
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.stop()
@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Append-only message log for one group. Records are the relayed JSON lines
+# (ciphertext stays opaque for the encrypted group) written to numbered
+# segment files. Each segment has an index of u64 record offsets, so a
+# sequence number maps to a file position in O(1).
+#
+#   <dir>/<first seq>.log   records, one JSON line each
+#   <dir>/<first seq>.idx   offset of every record in the .log file
+#
+# Appends are handed to a writer thread which writes everything queued since
+# its last pass and then fsyncs once (group commit). Reads memory-map the
+# segments and are meant to run in an executor.
+
+OFFSET = struct.Struct("<Q")
+
+
+class MessageStore:
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, max_segments: int = 16, fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.maps = {}
+        self.map_lock = threading.Lock()
+        self.last_seq = 0
+        if self.bases:
+            base = self.bases[-1]
+            self.last_seq = base + os.path.getsize(self._path(base, ".idx")) // OFFSET.size - 1
+        self.committed = self.last_seq
+        self.queue = queue.SimpleQueue()
+        self.log_file = None
+        self.index_file = None
+        self.thread = threading.Thread(target=self._writer, name=f"store-{os.path.basename(directory)}", daemon=True)
+        self.thread.start()
+
+    def _path(self, base: int, suffix: str) -> str:
+        return os.path.join(self.directory, f"{base:020d}{suffix}")
+
+    @property
+    def first_seq(self) -> int:
+        # Oldest sequence number still retained
+        bases = self.bases
+        return bases[0] if bases else self.last_seq + 1
+
+    def next_seq(self) -> int:
+        self.last_seq += 1
+        return self.last_seq
+
+    def append(self, seq: int, line: bytes):
+        # seq must come from next_seq() and be appended in that order
+        self.queue.put((seq, line))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(5)
+
+    async def wait_committed(self, seq: int, poll: float = 0.002):
+        while self.committed < seq and self.thread.is_alive():
+            await asyncio.sleep(poll)
+
+    # Writer thread
+
+    def _open_segment(self, base: int):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.index_file.close()
+        self.log_file = open(self._path(base, ".log"), "ab")
+        self.index_file = open(self._path(base, ".idx"), "ab")
+        if not self.bases or self.bases[-1] != base:
+            self.bases.append(base)
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        while self.max_segments and len(self.bases) > self.max_segments:
+            base = self.bases.pop(0)
+            with self.map_lock:
+                for suffix in (".log", ".idx"):
+                    mapped = self.maps.pop((base, suffix), None)
+                    if mapped is not None:
+                        mapped.close()
+            for suffix in (".log", ".idx"):
+                try:
+                    os.unlink(self._path(base, suffix))
+                except FileNotFoundError:
+                    pass
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            records = [item for item in batch if item is not None]
+            try:
+                for seq, line in records:
+                    if self.log_file is None:
+                        self._open_segment(self.bases[-1] if self.bases else seq)
+                    elif self.log_file.tell() >= self.segment_bytes:
+                        self._open_segment(seq)
+                    self.index_file.write(OFFSET.pack(self.log_file.tell()))
+                    self.log_file.write(line)
+                if records:
+                    self.log_file.flush()
+                    self.index_file.flush()
+                    if self.fsync:
+                        os.fsync(self.log_file.fileno())
+                        os.fsync(self.index_file.fileno())
+                    self.committed = records[-1][0]
+            except Exception as e:
+                logger.error("Message store %s failed: %s", self.directory, e)
+                return
+            if stop:
+                if self.log_file is not None:
+                    self.log_file.close()
+                    self.index_file.close()
+                return
+
+    # Readers
+
+    def _map(self, base: int, suffix: str, needed: int):
+        # Segments are re-mapped when the part we need was written after
+        # the last mapping
+        key = (base, suffix)
+        with self.map_lock:
+            current = self.maps.get(key)
+            if current is not None and len(current) >= needed:
+                return current
+            path = self._path(base, suffix)
+            try:
+                size = os.path.getsize(path)
+                if size < needed or size == 0:
+                    return None
+                with open(path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                return None
+            if current is not None:
+                current.close()
+            self.maps[key] = mapped
+            return mapped
+
+    def read(self, first: int, last: int) -> list:
+        # Records first..last (inclusive) that are committed and still
+        # retained. Records that are gone are skipped, so the result can be
+        # shorter than the range
+        last = min(last, self.committed)
+        records = []
+        seq = max(first, 1)
+        bases = list(self.bases)
+        while seq <= last and bases:
+            i = bisect.bisect_right(bases, seq) - 1
+            if i < 0:
+                seq = bases[0]
+                continue
+            base = bases[i]
+            end = min(last, bases[i + 1] - 1 if i + 1 < len(bases) else last)
+            index = self._map(base, ".idx", (end - base + 1) * OFFSET.size)
+            log = index and self._map(base, ".log", OFFSET.unpack_from(index, (end - base) * OFFSET.size)[0] + 1)
+            if not index or not log:
+                # Deleted by retention since we copied self.bases
+                seq = end + 1
+                continue
+            try:
+                for s in range(seq, end + 1):
+                    start = OFFSET.unpack_from(index, (s - base) * OFFSET.size)[0]
+                    stop = log.find(b"\n", start)
+                    if stop < 0:
+                        # Mapped while this record was still being written
+                        log = self._map(base, ".log", len(log) + 1)
+                        stop = log.find(b"\n", start) if log else -1
+                        if stop < 0:
+                            return records
+                    records.append(log[start:stop + 1])
+            except ValueError:
+                # The segment was dropped by retention while we read it
+                pass
+            seq = end + 1
+        return records
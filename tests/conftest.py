@@ -0,0 +1,76 @@
+import json
+import os
+import sys
+import pytest
+
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeTransport:
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+# Stands in for a client's StreamWriter, keeps everything written to it
+class FakeWriter:
+    def __init__(self, peername=("127.0.0.1", 1)):
+        self.transport = FakeTransport()
+        self.data = bytearray()
+        self.peername = peername
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.data += data
+
+    def writelines(self, lines):
+        for data in lines:
+            self.data += data
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return {"peername": self.peername}.get(name, default)
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+    def messages(self) -> list:
+        return [json.loads(line) for line in bytes(self.data).splitlines()]
+
+
+@pytest.fixture
+def fake_writer():
+    return FakeWriter
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    # server.py reads .env, and writes a default one, from the working
+    # directory when it is imported
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    try:
+        import server
+    finally:
+        os.chdir(cwd)
+    return server
+
+
+@pytest.fixture
+def chat(server, monkeypatch):
+    # The scheduler is tied to the event loop it first ran on and every
+    # test runs its own loop
+    from ingress import Ingress
+    from ratelimit import RateLimiter
+    monkeypatch.setattr(server, "ingress", Ingress(server.INGRESS_QUEUE_SIZE, server.INGRESS_QUANTUM))
+    monkeypatch.setattr(server, "rate_limiter", RateLimiter(server.RATE_LIMIT, server.RATE_WINDOW))
+    return server
@@ -0,0 +1,95 @@
+import asyncio
+from bus import BusClient, BusPeer, Hub, bind_unix, encode
+
+
+class StuckTransport:
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+class StuckWriter:
+    # A peer that never reads: drain() waits until released
+    def __init__(self):
+        self.transport = StuckTransport()
+        self.written = []
+        self.released = asyncio.Event()
+
+    def writelines(self, lines):
+        self.written.extend(lines)
+
+    async def drain(self):
+        await self.released.wait()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def test_peer_drops_broadcasts_then_disconnects():
+    async def run():
+        writer = StuckWriter()
+        peer = BusPeer(writer, max_bytes=100)
+        line = b"x" * 60 + b"\n"
+        assert peer.send(line, droppable=True)
+        await asyncio.sleep(0)
+        # The first line is in flight and counts until drain() returns
+        assert peer.send(line, droppable=True)
+        assert not peer.send(line, droppable=True)
+        assert peer.dropped == 1
+        # Control lines are still queued past the limit
+        assert peer.send(line)
+        assert peer.send(line)
+        assert not peer.send(line)
+        assert writer.transport.aborted and peer.closed
+
+    asyncio.run(run())
+
+
+def test_peer_writes_after_drain():
+    async def run():
+        writer = StuckWriter()
+        writer.released.set()
+        peer = BusPeer(writer, max_bytes=100)
+        for i in range(3):
+            peer.send(encode({"op": "ready", "n": i}), droppable=True)
+        await asyncio.sleep(0.01)
+        assert len(writer.written) == 3 and peer.queued == 0
+        await peer.close()
+
+    asyncio.run(run())
+
+
+def test_hub_claims_and_forwards(tmp_path):
+    async def run():
+        hub = Hub()
+        serving = asyncio.create_task(hub.serve(bind_unix(str(tmp_path / "bus.sock"))))
+        received = []
+        joined = []
+        clients = []
+        for _ in range(2):
+            client = BusClient(lambda *args: received.append(args), lambda *args: joined.append(args),
+                               lambda *args: None, lambda *args: None, lambda *args: None)
+            await client.connect(str(tmp_path / "bus.sock"))
+            clients.append(client)
+        first, second = clients
+        assert await first.claim(True, "Alice")
+        assert not await second.claim(True, "alice")
+        assert await second.claim(False, "alice")
+        first.publish(True, "lobby", b'{"payload": "hi"}\n')
+        for _ in range(50):
+            if received:
+                break
+            await asyncio.sleep(0.01)
+        assert received == [(True, "lobby", b'{"payload": "hi"}\n')]
+        assert (True, "Alice") in joined
+        for client in clients:
+            await client.close()
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+    asyncio.run(run())
@@ -0,0 +1,200 @@
+import asyncio
+import pytest
+from chatclient import ChatClient, Event, payload_bytes, split_payload
+from store import MessageStore
+
+
+async def start_server(chat):
+    listener = await asyncio.start_server(chat.handle_client, "127.0.0.1", 0, limit=max(chat.STREAM_LIMIT, chat.MAX_FRAME_BYTES))
+    ingress = asyncio.create_task(chat.ingress.run())
+    return listener, ingress, listener.sockets[0].getsockname()[1]
+
+
+async def stop_server(listener, ingress, *clients):
+    for client in clients:
+        await client.close()
+    ingress.cancel()
+    listener.close()
+    await listener.wait_closed()
+
+
+async def next_event(client, type: str) -> "Event":
+    async def wait():
+        async for event in client:
+            if event.type == type:
+                return event
+    return await asyncio.wait_for(wait(), 5)
+
+
+def test_encrypted_client_needs_a_key():
+    with pytest.raises(ValueError):
+        ChatClient("localhost", 8000, "bot", encrypted=True)
+
+
+def test_send_and_receive(chat):
+    async def run():
+        listener, ingress, port = await start_server(chat)
+        alice = ChatClient("127.0.0.1", port, "alice", encrypted=False)
+        bob = ChatClient("127.0.0.1", port, "bob", encrypted=False)
+        await alice.connect()
+        await bob.connect()
+        await next_event(alice, "users")
+        alice.send_nowait("hello")
+        event = await next_event(bob, "message")
+        await stop_server(listener, ingress, alice, bob)
+        return event
+    event = asyncio.run(run())
+    assert (event.username, event.text) == ("alice", "hello")
+
+
+def test_reconnects_and_resends(chat):
+    async def run():
+        listener, ingress, port = await start_server(chat)
+        alice = ChatClient("127.0.0.1", port, "alice", encrypted=False, reconnect_base_delay=0.01)
+        bob = ChatClient("127.0.0.1", port, "bob", encrypted=False)
+        await alice.connect()
+        await bob.connect()
+        alice.writer.transport.abort()
+        await next_event(alice, "disconnected")
+        # Queued while disconnected, sent after reconnecting
+        alice.send_nowait("back")
+        await next_event(alice, "connected")
+        event = await next_event(bob, "message")
+        await stop_server(listener, ingress, alice, bob)
+        return alice.connections, event
+    connections, event = asyncio.run(run())
+    assert connections == 2
+    assert event.text == "back"
+
+
+def test_full_outbox_drops_oldest():
+    async def run():
+        client = ChatClient("localhost", 8000, "bot", encrypted=False, max_pending=2)
+        for text in ("one", "two", "three"):
+            client.send_nowait(text)
+        return client
+    client = asyncio.run(run())
+    assert [text for text, _, _ in client.outgoing] == ["two", "three"]
+    assert client.dropped == 1
+
+
+def test_message_that_cannot_be_encoded_is_dropped(chat):
+    async def run():
+        listener, ingress, port = await start_server(chat)
+        alice = ChatClient("127.0.0.1", port, "alice", encrypted=False, binary=False)
+        bob = ChatClient("127.0.0.1", port, "bob", encrypted=False)
+        await alice.connect()
+        await bob.connect()
+        alice.send_nowait(object())
+        alice.send_nowait("after")
+        error = await next_event(alice, "system")
+        event = await next_event(bob, "message")
+        await stop_server(listener, ingress, alice, bob)
+        return alice, error, event
+    alice, error, event = asyncio.run(run())
+    assert error.text.startswith("Message not sent")
+    assert event.text == "after"
+    assert alice.connections == 1
+
+
+@pytest.mark.parametrize("encrypted", [False, True])
+@pytest.mark.parametrize("text", ["a" * 100000, "😀" * 30000, "é" * 50000, ""])
+def test_split_payload_fits_budget(text, encrypted):
+    pieces = split_payload(text, 4096, encrypted)
+    assert "".join(pieces) == text
+    assert all(payload_bytes(piece, encrypted) <= 4096 for piece in pieces)
+    # Only the last piece may have room for another character
+    assert all(payload_bytes(piece + text[0], encrypted) > 4096 for piece in pieces[:-1])
+
+
+def test_send_large_emoji(chat):
+    # Astral characters take 12 bytes in JSON, a chunk cut by characters
+    # would be over the frame limit
+    text = "😀" * 20000
+
+    async def run():
+        listener, ingress, port = await start_server(chat)
+        alice = ChatClient("127.0.0.1", port, "alice", encrypted=False, max_frame_bytes=chat.MAX_FRAME_BYTES)
+        bob = ChatClient("127.0.0.1", port, "bob", encrypted=False)
+        await alice.connect()
+        await bob.connect()
+        assert not alice.fits_frame(text)
+        await alice.send_large(text)
+        parts = []
+        while True:
+            event = await next_event(bob, "chunk")
+            assert not event.data.get("aborted")
+            parts.append(event.text)
+            if event.data.get("final"):
+                break
+        await stop_server(listener, ingress, alice, bob)
+        return parts
+    parts = asyncio.run(run())
+    assert len(parts) > 1
+    assert "".join(parts) == text
+
+
+def test_backlog_only_skips_messages():
+    async def run():
+        client = ChatClient("localhost", 8000, "bot", encrypted=False, max_backlog=2)
+        client.tasks = [asyncio.create_task(client.decode_loop())]
+        for event in [
+            Event("disconnected", "gone"),
+            Event("message", "m1"),
+            Event("chunk", "part0", data={"id": "t", "index": 0}),
+            Event("message", "m2"),
+            Event("users", "Current Users"),
+            Event("message", "m3"),
+            Event("message", "m4"),
+        ]:
+            client._emit(event)
+        await asyncio.sleep(0)
+        events = client.events_nowait()
+        await client.close()
+        return events
+    events = asyncio.run(run())
+    assert [(event.type, event.text) for event in events] == [
+        ("disconnected", "gone"),
+        ("system", "2 messages skipped"),
+        ("chunk", "part0"),
+        ("users", "Current Users"),
+        ("message", "m3"),
+        ("message", "m4"),
+    ]
+
+
+def test_resume_does_not_replay_own_messages(chat, tmp_path, monkeypatch):
+    async def run():
+        monkeypatch.setattr(chat, "stores", {False: MessageStore(str(tmp_path), fsync=False)})
+        listener, ingress, port = await start_server(chat)
+        alice = ChatClient("127.0.0.1", port, "alice", encrypted=False, reconnect_base_delay=0.01)
+        bob = ChatClient("127.0.0.1", port, "bob", encrypted=False, reconnect=False)
+        await alice.connect()
+        await bob.connect()
+        for i in range(3):
+            alice.send_nowait(f"pre{i}")
+        for i in range(3):
+            await next_event(bob, "message")
+        alice.writer.transport.abort()
+        await next_event(alice, "disconnected")
+        # Missed while alice is away, so it comes from the store
+        bob.send_nowait("while away")
+        await bob.flush()
+        await asyncio.sleep(0.05)
+        caught_up = None
+        received = []
+        async def collect():
+            nonlocal caught_up
+            async for event in alice:
+                if event.type == "message":
+                    received.append((event.username, event.text))
+                elif event.type == "system" and event.data and "replay" in event.data:
+                    caught_up = event.data["replay"]
+                    return
+        await asyncio.wait_for(collect(), 5)
+        await stop_server(listener, ingress, alice, bob)
+        chat.stores[False].close()
+        return caught_up, received
+    caught_up, received = asyncio.run(run())
+    assert received == [("bob", "while away")]
+    assert caught_up == 1
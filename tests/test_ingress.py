@@ -0,0 +1,79 @@
+import asyncio
+from ingress import Ingress
+
+
+def test_wait_idle_handles_everything_queued():
+    async def run():
+        ingress = Ingress(queue_size=2, quantum=1)
+        handled = []
+        for key in ("a", "b"):
+            ingress.add(key)
+            for i in range(2):
+                await ingress.submit(key, 1, handled.append, (key, i))
+        # "a" is full, this one waits for space
+        blocked = asyncio.create_task(ingress.submit("a", 1, handled.append, ("a", 2)))
+        await asyncio.sleep(0)
+        task = asyncio.create_task(ingress.run())
+        await asyncio.wait_for(ingress.wait_idle(), 1)
+        task.cancel()
+        await blocked
+        assert len(ingress) == 0
+        assert sorted(handled) == [("a", 0), ("a", 1), ("a", 2), ("b", 0), ("b", 1)]
+    asyncio.run(run())
+
+
+def test_clear_releases_waiting_callers():
+    async def run():
+        ingress = Ingress()
+        ingress.add("a")
+        call = asyncio.create_task(ingress.call("a", 1, lambda: "result"))
+        await asyncio.sleep(0)
+        assert len(ingress) == 1
+        ingress.clear()
+        await asyncio.wait_for(ingress.wait_empty("a"), 1)
+        try:
+            await call
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("call() should be cancelled")
+    asyncio.run(run())
+
+
+def test_senders_share_turns_by_cost():
+    # A sender with large frames does not starve one with small frames:
+    # each gets about a quantum of bytes per turn
+    async def run():
+        ingress = Ingress(queue_size=100, quantum=1000, batch=1000)
+        handled = []
+        ingress.add("big")
+        ingress.add("small")
+        for i in range(10):
+            await ingress.submit("big", 1000, handled.append, "big")
+        for i in range(10):
+            await ingress.submit("small", 100, handled.append, "small")
+        task = asyncio.create_task(ingress.run())
+        await asyncio.wait_for(ingress.wait_idle(), 1)
+        task.cancel()
+        return handled
+    handled = asyncio.run(run())
+    # One 1000 byte frame, then ten 100 byte frames in the same turn
+    assert handled[:11] == ["big"] + ["small"] * 10
+    assert handled.count("big") == 10
+
+
+def test_weight_scales_the_share():
+    async def run():
+        ingress = Ingress(queue_size=100, quantum=100, batch=1000)
+        handled = []
+        ingress.add("a", weight=3)
+        ingress.add("b")
+        for key in ("a", "b"):
+            for i in range(12):
+                await ingress.submit(key, 100, handled.append, key)
+        task = asyncio.create_task(ingress.run())
+        await asyncio.wait_for(ingress.wait_idle(), 1)
+        task.cancel()
+        return handled
+    handled = asyncio.run(run())
+    assert handled[:8] == ["a", "a", "a", "b"] * 2
@@ -0,0 +1,54 @@
+import logging
+import queue
+import threading
+from logqueue import BoundedQueueListener, DroppingQueueHandler
+
+
+class BlockingHandler(logging.Handler):
+    # Holds the listener thread on its first record until released
+    def __init__(self):
+        super().__init__()
+        self.released = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.messages.append(record.getMessage())
+
+
+def make_record(message: str) -> logging.LogRecord:
+    return logging.LogRecord("test", logging.INFO, __file__, 0, message, None, None)
+
+
+def test_full_queue_drops_records():
+    log_queue = queue.Queue(1)
+    dropped = []
+    handler = DroppingQueueHandler(log_queue, on_drop=lambda: dropped.append(1))
+    handler.handle(make_record("one"))
+    handler.handle(make_record("two"))
+    assert log_queue.qsize() == 1
+    assert handler.dropped == 1 and dropped == [1]
+
+
+def test_stop_waits_for_room():
+    log_queue = queue.Queue(2)
+    handler = BlockingHandler()
+    listener = BoundedQueueListener(log_queue, handler, timeout=5)
+    listener.start()
+    for message in ("one", "two", "three"):
+        log_queue.put(make_record(message), timeout=1)
+    threading.Timer(0.1, handler.released.set).start()
+    listener.stop()
+    assert handler.messages == ["one", "two", "three"]
+
+
+def test_stop_drops_oldest_record_when_stuck():
+    log_queue = queue.Queue(2)
+    handler = BlockingHandler()
+    listener = BoundedQueueListener(log_queue, handler, timeout=0.05)
+    listener.start()
+    for message in ("one", "two", "three"):
+        log_queue.put(make_record(message), timeout=1)
+    threading.Timer(0.3, handler.released.set).start()
+    listener.stop()
+    assert handler.messages == ["one", "three"]
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import pytest
+from protocol import HEADER, KIND_CHAT, Frame, FrameTooLarge, chat_packet, encode_message, read_frame
+
+
+def read_all(data: bytes, binary: bool = False, limit: int = 64, reader_limit: int = 2 ** 16) -> list:
+    # Every frame in data, with FrameTooLarge in place of the skipped ones
+    async def run():
+        reader = asyncio.StreamReader(reader_limit)
+        reader.feed_data(data)
+        reader.feed_eof()
+        frames = []
+        while True:
+            try:
+                frame = await read_frame(reader, binary, limit)
+            except FrameTooLarge:
+                frames.append(FrameTooLarge)
+                continue
+            if frame is None:
+                return frames
+            frames.append(frame.message)
+    return asyncio.run(run())
+
+
+def test_oversized_line_is_skipped():
+    big = encode_message({"text": "x" * 100})
+    assert read_all(encode_message({"n": 1}) + big + encode_message({"n": 2})) == [{"n": 1}, FrameTooLarge, {"n": 2}]
+
+
+def test_line_over_reader_limit_is_skipped():
+    big = encode_message({"text": "x" * 1000})
+    frames = read_all(big + encode_message({"n": 2}), limit=64, reader_limit=128)
+    assert frames == [FrameTooLarge, {"n": 2}]
+
+
+def test_oversized_packet_is_skipped():
+    big = encode_message({"text": "x" * 100}, binary=True)
+    frames = read_all(big + encode_message({"n": 2}, binary=True), binary=True)
+    assert frames == [FrameTooLarge, {"n": 2}]
+
+
+def test_chat_packet_round_trip():
+    packet = chat_packet("alice", "héllo 😀".encode(), KIND_CHAT)
+    assert read_all(packet, binary=True) == [{"username": "alice", "payload": "héllo 😀"}]
+
+
+@pytest.mark.parametrize("frame", [
+    Frame.from_line(b'{"username": "alice", "payload": "hi"}\n'),
+    Frame.from_packet(KIND_CHAT, chat_packet("alice", b"hi"), chat_packet("alice", b"hi")[HEADER.size:]),
+])
+def test_with_seq(frame):
+    stamped = frame.with_seq(7)
+    assert json.loads(stamped.line) == {"seq": 7, "username": "alice", "payload": "hi"}
+    assert read_all(stamped.packet, binary=True) == [{"seq": 7, "username": "alice", "payload": "hi"}]
@@ -0,0 +1,72 @@
+import pytest
+from ratelimit import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_burst_of_limit_then_limited():
+    clock = Clock()
+    limiter = RateLimiter(5, 10, clock)
+    assert [limiter.reserve("alice") for _ in range(5)] == [0.0] * 5
+    assert limiter.reserve("alice") > 0
+    # Other keys have their own allowance
+    assert limiter.reserve("bob") == 0.0
+
+
+def test_allowance_refills_over_the_window():
+    clock = Clock()
+    limiter = RateLimiter(5, 10, clock)
+    for _ in range(5):
+        limiter.reserve("alice")
+    # One message's worth of the window later there is room for one more
+    clock.now += 2
+    assert limiter.reserve("alice") == 0.0
+    assert limiter.reserve("alice") > 0
+    # Idle for a whole window after the last reservation
+    clock.now += 14
+    assert [limiter.reserve("alice") for _ in range(5)] == [0.0] * 5
+
+
+def test_idle_keys_are_evicted():
+    clock = Clock()
+    limiter = RateLimiter(5, 10, clock)
+    limiter.reserve("alice")
+    for _ in range(5):
+        limiter.reserve("bob")
+    clock.now += 2
+    assert limiter.evict_idle() == 1
+    assert len(limiter) == 1
+    clock.now += 10
+    assert limiter.evict_idle() == 1
+    assert len(limiter) == 0
+
+
+def test_reserve_spaces_out_messages_over_the_limit():
+    clock = Clock()
+    limiter = RateLimiter(5, 10, clock)
+    for _ in range(5):
+        limiter.reserve("alice")
+    # Every message is accepted, the ones over the limit are delayed one
+    # interval more each
+    assert [limiter.reserve("alice") for _ in range(3)] == [2.0, 4.0, 6.0]
+    # Waiting out the delay brings the key back within its limit
+    clock.now += 6
+    assert limiter.reserve("alice") == 2.0
+
+
+def test_zero_limit_means_no_limit():
+    limiter = RateLimiter(0, 10, Clock())
+    assert [limiter.reserve("alice") for _ in range(1000)] == [0.0] * 1000
+    assert len(limiter) == 0
+
+
+@pytest.mark.parametrize("limit, window", [(-1, 10), (5, 0)])
+def test_invalid_settings_are_refused(limit, window):
+    with pytest.raises(ValueError):
+        RateLimiter(limit, window)
@@ -0,0 +1,43 @@
+from registry import UserRegistry
+
+
+def test_names_are_case_folded():
+    registry = UserRegistry()
+    assert registry.add("conn1", "Alice")
+    assert not registry.add("conn2", "ALICE")
+    assert not registry.add("conn3", "alice")
+    assert registry.find("aLiCe") == "conn1"
+    # Folding goes beyond lower(): ß is "ss"
+    assert registry.add("conn4", "Straße")
+    assert registry.is_taken("STRASSE")
+    assert registry.user_list() == ["Alice", "Straße"]
+
+
+def test_remove_frees_the_name():
+    registry = UserRegistry()
+    registry.add("conn1", "Alice")
+    assert registry.remove("conn1") == "Alice"
+    assert registry.remove("conn1") is None
+    assert "conn1" not in registry
+    assert registry.add("conn2", "alice")
+    assert registry.get("conn2") == "alice"
+
+
+def test_remote_users_take_their_names():
+    registry = UserRegistry()
+    registry.add_remote("Bob")
+    assert not registry.add("conn1", "BOB")
+    assert registry.user_list() == ["Bob"]
+    registry.remove_remote("bob")
+    assert registry.add("conn1", "BOB")
+
+
+def test_user_list_is_cached_until_a_change():
+    registry = UserRegistry()
+    registry.add("conn1", "Alice")
+    users = registry.user_list()
+    version = registry.version
+    assert registry.user_list() is users
+    registry.add("conn2", "Bob")
+    assert registry.version == version + 1
+    assert registry.user_list() == ["Alice", "Bob"]
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import pytest
+
+
+async def start_client(server, fake_writer, username: str, **handshake):
+    reader = asyncio.StreamReader()
+    writer = fake_writer()
+    task = asyncio.create_task(server.handle_client(reader, writer))
+    reader.feed_data((json.dumps({"username": username, "encrypted": False, **handshake}) + "\n").encode())
+    return reader, writer, task
+
+
+async def finish(reader, task):
+    reader.feed_eof()
+    await asyncio.wait_for(task, 5)
+
+
+def run_session(server, fake_writer, lines: list, username: str = "alice") -> list:
+    # Sends the lines after the handshake and returns everything the
+    # server wrote back
+    async def run():
+        ingress = asyncio.create_task(server.ingress.run())
+        try:
+            reader, writer, task = await start_client(server, fake_writer, username)
+            for line in lines:
+                reader.feed_data((json.dumps(line) + "\n").encode())
+            await finish(reader, task)
+        finally:
+            ingress.cancel()
+        return writer.messages()
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("line", [
+    {"type": "join", "room": ["a"]},
+    {"type": "leave", "room": {"a": 1}},
+    {"type": "resync", "room": 5},
+    {"text": "hi", "room": ["a"]},
+    {"type": "chunk", "id": "t1", "index": 0, "room": ["a"], "payload": "x"},
+])
+def test_invalid_rooms_are_refused(chat, fake_writer, line):
+    messages = run_session(chat, fake_writer, [line])
+    assert messages[-1]["text"] == "Room name cannot be empty"
+
+
+def test_commands_are_rate_limited(chat, fake_writer, monkeypatch):
+    charged = []
+    monkeypatch.setattr(chat, "rate_limit_delay", lambda username: charged.append(username) or 0.0)
+    run_session(chat, fake_writer, [
+        {"type": "rooms"},
+        {"type": "join", "room": "lobby"},
+        {"text": "hi"},
+        {"type": "chunk", "id": "t1", "index": 0, "payload": "x"},
+        {"type": "chunk", "id": "t1", "index": 1, "payload": "x", "final": True},
+    ], username="bob")
+    # Every command and message once, the transfer once
+    assert charged == ["bob"] * 4
+
+
+def test_messages_while_draining_are_refused(chat, fake_writer, monkeypatch):
+    async def run():
+        ingress = asyncio.create_task(chat.ingress.run())
+        try:
+            reader, writer, task = await start_client(chat, fake_writer, "carol")
+            await asyncio.sleep(0.01)
+            monkeypatch.setattr(chat, "draining", True)
+            for text in ("one", "two"):
+                reader.feed_data((json.dumps({"text": text}) + "\n").encode())
+            await finish(reader, task)
+        finally:
+            ingress.cancel()
+        return writer.messages()
+    messages = asyncio.run(run())
+    texts = [message.get("text") for message in messages]
+    assert texts.count(chat.NOT_DELIVERED.message["text"]) == 1
+
+
+def send(reader, message: dict):
+    reader.feed_data((json.dumps(message) + "\n").encode())
+
+
+def chunks(writer) -> list:
+    return [message for message in writer.messages() if message.get("type") == "chunk"]
+
+
+def test_chunks_are_relayed_in_order(chat, fake_writer):
+    async def run():
+        ingress = asyncio.create_task(chat.ingress.run())
+        try:
+            reader, writer, task = await start_client(chat, fake_writer, "alice")
+            bob_reader, bob, bob_task = await start_client(chat, fake_writer, "bob")
+            await asyncio.sleep(0.01)
+            send(reader, {"type": "chunk", "id": "t1", "index": 0, "payload": "one ", "size": 12, "name": "notes"})
+            send(reader, {"type": "chunk", "id": "t1", "index": 1, "payload": "two "})
+            send(reader, {"type": "chunk", "id": "t1", "index": 2, "payload": "three", "final": True})
+            await finish(reader, task)
+            await finish(bob_reader, bob_task)
+        finally:
+            ingress.cancel()
+        return chunks(bob)
+    received = asyncio.run(run())
+    assert [chunk["index"] for chunk in received] == [0, 1, 2]
+    assert "".join(chunk["payload"] for chunk in received) == "one two three"
+    assert received[0]["name"] == "notes" and received[0]["size"] == 12
+    assert received[-1]["final"] and all(chunk["username"] == "alice" for chunk in received)
+
+
+@pytest.mark.parametrize("follow_up", [
+    # A chunk out of order aborts the transfer
+    {"type": "chunk", "id": "t1", "index": 2, "payload": "x"},
+    # So does disconnecting in the middle of it
+    None,
+])
+def test_transfers_are_aborted(chat, fake_writer, follow_up):
+    async def run():
+        ingress = asyncio.create_task(chat.ingress.run())
+        try:
+            reader, writer, task = await start_client(chat, fake_writer, "alice")
+            bob_reader, bob, bob_task = await start_client(chat, fake_writer, "bob")
+            await asyncio.sleep(0.01)
+            send(reader, {"type": "chunk", "id": "t1", "index": 0, "payload": "x"})
+            if follow_up is not None:
+                send(reader, follow_up)
+            await finish(reader, task)
+            await finish(bob_reader, bob_task)
+        finally:
+            ingress.cancel()
+        return chunks(bob)
+    received = asyncio.run(run())
+    assert [chunk.get("aborted", False) for chunk in received] == [False, True]
+
+
+def test_drain_stops_accepting_right_away(chat, monkeypatch):
+    monkeypatch.setattr(chat, "draining", False)
+    monkeypatch.setattr(chat, "DRAIN_TIMEOUT", 0.5)
+
+    async def run():
+        listener = await asyncio.start_server(chat.handle_client, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        # A queued message nobody handles keeps the drain waiting
+        chat.ingress.add("sender")
+        await chat.ingress.submit("sender", 1, lambda: None)
+        drain = asyncio.create_task(chat.drain([listener], [], restart=False))
+        await asyncio.sleep(0.05)
+        assert not drain.done()
+        try:
+            with pytest.raises(ConnectionRefusedError):
+                await asyncio.open_connection("127.0.0.1", port)
+        finally:
+            await drain
+    asyncio.run(run())
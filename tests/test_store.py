@@ -0,0 +1,104 @@
+import asyncio
+import json
+import time
+from store import MessageStore
+
+
+def fill(store: MessageStore, count: int, room: str = "lobby") -> list:
+    lines = []
+    for _ in range(count):
+        seq = store.next_seq()
+        line = (json.dumps({"seq": seq, "room": room, "payload": "x" * 40}) + "\n").encode()
+        store.append(seq, line)
+        lines.append(line)
+    return lines
+
+
+def committed(store: MessageStore):
+    asyncio.run(store.wait_committed(store.last_seq))
+
+
+def test_read_across_segments(tmp_path):
+    store = MessageStore(str(tmp_path), segment_bytes=200, max_segments=0, fsync=False)
+    lines = fill(store, 20)
+    committed(store)
+    assert len(store.bases) > 1
+    assert store.read(1, 20) == lines
+    assert store.read(5, 7) == lines[4:7]
+    assert store.read(19, 100) == lines[18:]
+    store.close()
+
+
+def test_retention_and_first_seq(tmp_path):
+    store = MessageStore(str(tmp_path), segment_bytes=200, max_segments=2, fsync=False)
+    lines = fill(store, 40)
+    committed(store)
+    assert len(store.bases) == 2
+    first = store.first_seq
+    assert first > 1
+    # A range that starts before the oldest segment returns what is left
+    assert store.read(1, 40) == lines[first - 1:]
+    assert store.read(1, first - 1) == []
+    store.close()
+
+
+def test_reopen_continues_sequence(tmp_path):
+    store = MessageStore(str(tmp_path), segment_bytes=200, fsync=False)
+    lines = fill(store, 10)
+    committed(store)
+    store.close()
+    store = MessageStore(str(tmp_path), segment_bytes=200, fsync=False)
+    assert store.last_seq == 10
+    lines += fill(store, 5)
+    committed(store)
+    assert store.read(1, 15) == lines
+    store.close()
+
+
+def test_replay_starts_at_oldest_retained(tmp_path, server, fake_writer):
+    store = MessageStore(str(tmp_path), segment_bytes=200, max_segments=2, fsync=False)
+    fill(store, 40)
+    committed(store)
+    first = store.first_seq
+
+    async def run():
+        writer = fake_writer()
+        conn = server.ClientConnection(writer)
+        # since=0 is older than anything retained
+        await conn.replay(store, 0, {"lobby"})
+        await conn.close()
+        return writer.messages()
+
+    messages = asyncio.run(run())
+    seqs = [m["seq"] for m in messages if "payload" in m]
+    assert seqs == list(range(first, 41))
+    assert messages[-1]["replay"] == len(seqs)
+    store.close()
+
+
+def test_one_replay_at_a_time_and_cancelled_on_close(tmp_path, server, fake_writer, monkeypatch):
+    store = MessageStore(str(tmp_path), fsync=False)
+    fill(store, 10)
+    committed(store)
+    reads = []
+
+    def slow_read(first, last):
+        reads.append(first)
+        time.sleep(0.05)
+        return []
+    monkeypatch.setattr(store, "read", slow_read)
+    monkeypatch.setattr(server, "REPLAY_BATCH", 1)
+
+    async def run():
+        conn = server.ClientConnection(fake_writer())
+        assert conn.start_replay(store, 0, {"lobby"})
+        assert not conn.start_replay(store, 0, {"lobby"})
+        task = conn.replay_task
+        await asyncio.sleep(0.01)
+        await conn.close()
+        return task
+
+    task = asyncio.run(run())
+    assert task.cancelled()
+    assert len(reads) < 10
+    store.close()
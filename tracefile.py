@@ -0,0 +1,109 @@
+import gzip
+import itertools
+import logging
+import os
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Traffic traces for replay.py. A trace is a magic line followed by one
+# record per event handle_client saw, in the order it saw them:
+#
+#   Record: time (f64, seconds since the trace started) | connection (u32)
+#           | kind (u8) | data length (u32) | data
+#   OPEN    a connection was admitted, no data
+#   LINE    a JSON line as received, newline included
+#   PACKET  a binary packet as received, header included
+#   CLOSE   the connection ended, no data
+#
+# Frames are stored exactly as they came off the wire, so a replay goes
+# through the same parsing as live traffic. A path ending in .gz is
+# gzip compressed.
+
+MAGIC = b"ENIGMA-TRACE 1\n"
+RECORD = struct.Struct("!dIBI")
+OPEN = 0
+LINE = 1
+PACKET = 2
+CLOSE = 3
+
+
+def open_trace(path: str, mode: str):
+    if path.endswith(".gz"):
+        # Level 1 keeps compression cheap while recording
+        return gzip.open(path, mode, compresslevel=1) if "w" in mode else gzip.open(path, mode)
+    return open(path, mode, buffering=1 << 16)
+
+
+def free_path(path: str) -> str:
+    # trace.bin, then trace-1.bin and so on, an existing trace (e.g. from
+    # before a restart) is never overwritten
+    root, ext = os.path.splitext(path)
+    for n in itertools.count(1):
+        if not os.path.exists(path):
+            return path
+        path = f"{root}-{n}{ext}"
+
+
+# Records are written from the event loop into a buffered file, so a
+# trace costs one struct pack and a memory copy per frame. Recording stops
+# once max_bytes of frames have been written, 0 for no limit
+
+class TraceWriter:
+    def __init__(self, path: str, max_bytes: int = 0, clock=time.monotonic):
+        self.path = free_path(path)
+        self.file = open_trace(self.path, "wb")
+        self.file.write(MAGIC)
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.clock = clock
+        self.started = clock()
+        self.ids = itertools.count()
+        self.full = False
+
+    def record(self, connection: int, kind: int, data: bytes = b""):
+        if self.full:
+            return
+        if self.max_bytes and self.written + len(data) > self.max_bytes:
+            self.full = True
+            logger.warning("Trace stopped after %d bytes (TRACE_MAX_BYTES)", self.written)
+            return
+        self.file.write(RECORD.pack(self.clock() - self.started, connection, kind, len(data)))
+        if data:
+            self.file.write(data)
+        self.written += RECORD.size + len(data)
+
+    def open(self) -> int:
+        connection = next(self.ids)
+        self.record(connection, OPEN)
+        return connection
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path: str):
+    # Yields (time, connection, kind, data) in recorded order. A trace from
+    # a server that did not shut down cleanly can end in a partial record,
+    # which is left out
+    with open_trace(path, "rb") as f:
+        if f.readline() != MAGIC:
+            raise ValueError(f"{path} is not an Enigma trace")
+        while True:
+            try:
+                header = f.read(RECORD.size)
+                if not header:
+                    return
+                data = b""
+                if len(header) == RECORD.size:
+                    timestamp, connection, kind, length = RECORD.unpack(header)
+                    data = f.read(length)
+            except EOFError:
+                header = b""
+            if len(header) < RECORD.size or len(data) < length:
+                logger.warning("%s ends in a partial record", path)
+                return
+            yield timestamp, connection, kind, data
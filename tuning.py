@@ -0,0 +1,43 @@
+import asyncio
+import logging
+import socket
+
+
+logger = logging.getLogger(__name__)
+
+
+# Opt-in fast path shared by the server and the client: uvloop when it is
+# installed, and socket options tuned for small, latency sensitive frames
+
+def install_event_loop(use_uvloop: bool) -> bool:
+    if not use_uvloop:
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("USE_UVLOOP is set but uvloop is not installed, using the default asyncio loop")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def tune_socket(sock, sndbuf: int = 0, rcvbuf: int = 0, keepalive: bool = True,
+                keepidle: int = 0, keepintvl: int = 0, keepcnt: int = 0):
+    # Every option is best effort, platforms without one just skip it
+    if sock is None:
+        return
+    options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+    if sndbuf:
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf))
+    if rcvbuf:
+        options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf))
+    if keepalive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        for name, value in (("TCP_KEEPIDLE", keepidle), ("TCP_KEEPINTVL", keepintvl), ("TCP_KEEPCNT", keepcnt)):
+            if value and hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    for level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except (OSError, AttributeError):
+            pass